@@ -0,0 +1,89 @@
+"""Measure peak memory while ingesting a large synthetic album.
+
+Each mode runs in a fresh interpreter so that peak RSS is not shared
+between them. Run from the repository root with
+`python -m benchmarks.album_memory`.
+"""
+
+from dataclasses import asdict
+from typing import Iterator
+import argparse
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+
+from src.scrape.common import insert_or_ignore, peak_memory_mb
+from src.scrape.models import Image
+from src.utils import migrate
+
+
+with open("src/sql/schema.sql") as fh:
+    setup_sql = fh.read()
+
+
+def make_album(n_images: int, image_kb: int) -> Iterator[Image]:
+    for i in range(n_images):
+        yield Image(
+            id=str(i),
+            media_id=1,
+            album_id="album",
+            title=None,
+            description=f"Image {i}",
+            datetime=1_500_000_000,
+            type="image/jpeg",
+            link=f"https://i.imgur.com/{i}.jpg",
+            views=0,
+            img=os.urandom(image_kb * 1024),
+        )
+
+def ingest_asdict(cursor: sqlite3.Cursor, images: Iterator[Image]) -> None:
+    for image in images:
+        d = asdict(image)
+        names, values = zip(*d.items())
+        targets = ', '.join(names)
+        params = ', '.join(["?" for _ in values])
+        sql = f"insert or ignore into images ({targets}) values ({params})"
+        cursor.execute(sql, values)
+
+def ingest_encoder(cursor: sqlite3.Cursor, images: Iterator[Image]) -> None:
+    for image in images:
+        insert_or_ignore(cursor, "images", image)
+
+def run_child(mode: str, n_images: int, image_kb: int) -> None:
+    ingest = {"asdict": ingest_asdict, "encoder": ingest_encoder}[mode]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        conn = sqlite3.connect(os.path.join(tmpdir, "bench.db"))
+        conn.executescript(setup_sql)
+        migrate(conn.cursor())
+        baseline = peak_memory_mb()
+        ingest(conn.cursor(), make_album(n_images, image_kb))
+        conn.commit()
+        conn.close()
+
+    print(f"{mode:>8}: peak RSS {peak_memory_mb():8.1f} MB (baseline {baseline:.1f} MB)")
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", "--images", type=int, default=500, help="Album size.")
+    parser.add_argument("-k", "--image-kb", type=int, default=1024, help="Image size.")
+    parser.add_argument("--mode", choices=("asdict", "encoder"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mode is not None:
+        run_child(args.mode, args.images, args.image_kb)
+        return
+
+    for mode in ("asdict", "encoder"):
+        cmd = [
+            sys.executable, "-m", "benchmarks.album_memory",
+            "--mode", mode,
+            "--images", str(args.images),
+            "--image-kb", str(args.image_kb),
+        ]
+        subprocess.run(cmd, check=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""Compare reflective model construction against compiled decoders.
+
+Decodes the API payloads in `tests/data`. Run from the repository root
+with `python -m benchmarks.decode`.
+"""
+
+from timeit import timeit
+from typing import Any, Callable, Dict, List, Tuple
+import argparse
+import json
+
+from src.scrape.codecs import decoder
+from src.scrape.models import Image, Product, Submission
+
+
+def reflective(cls: Callable, **data) -> Any:
+    # The original `from_json`.
+    fields = getattr(cls, "__dataclass_fields__")
+    init_field_names = [f.name for f in fields.values() if f.init]
+    kwds = {name: data.get(name) for name in init_field_names}
+    return cls(**kwds)
+
+def load(path: str) -> Any:
+    with open(path) as fh:
+        return json.load(fh)
+
+def payloads() -> List[Tuple[str, type, List[Dict[str, Any]]]]:
+    listing = load("tests/data/listing.json")
+    submissions = [
+        {**child["data"], "search_query": "query"}
+        for child in listing["data"]["children"]
+    ]
+
+    album = load("tests/data/imgur-album.json")
+    images = [
+        {**img, "album_id": "album", "media_id": 1, "img": b""}
+        for img in album["data"]["images"]
+    ]
+
+    product = load("tests/data/zappos-product.json")
+    products = [{**raw, "id": 1} for raw in product["product"]]
+
+    return [
+        ("Submission", Submission, submissions),
+        ("Image", Image, images),
+        ("Product", Product, products),
+    ]
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", "--number", type=int, default=20_000, help="Repetitions.")
+    args = parser.parse_args()
+
+    for name, cls, records in payloads():
+        decode = decoder(cls)
+        timings = {
+            "reflective": timeit(
+                lambda: [reflective(cls, **record) for record in records],
+                number=args.number,
+            ),
+            "compiled": timeit(
+                lambda: [decode(record) for record in records],
+                number=args.number,
+            ),
+        }
+
+        n_decoded = args.number * len(records)
+        for kind, seconds in timings.items():
+            print(f"{name:>10} {kind:>10}: {n_decoded / seconds:>12,.0f} records/sec")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""Measure link extraction throughput by parser and number of workers.
+
+Builds a synthetic corpus of submissions in a temporary database, then
+extracts links from it once per parser and worker count. Run from the
+repository root with `python -m benchmarks.extract_links`.
+"""
+
+from time import perf_counter
+import argparse
+import html
+import os
+import sqlite3
+import tempfile
+
+from src.scrape.extract_links import ANCHOR_PARSERS, CHUNK_SIZE, ingest
+from src.utils import migrate
+
+
+with open("src/sql/schema.sql") as fh:
+    setup_sql = fh.read()
+
+BODY = html.escape(
+    """
+    <div class="md"><p>Picked these up last month, here's a quick review.</p>
+    <p>Album: <a href="https://imgur.com/a/{i}">the boots</a>, and a
+    <a href="https://i.redd.it/{i}.jpg">close-up</a> of the welt.</p>
+    <ul><li>Sizing: true to size</li><li>Leather: <strong>CXL</strong></li></ul>
+    <p>Bought from <a href="https://example.com/shop">the shop</a>.</p></div>
+    """
+)
+
+
+def make_corpus(path: str, n_submissions: int) -> None:
+    conn = sqlite3.connect(path)
+    conn.executescript(setup_sql)
+    migrate(conn.cursor())
+    conn.executemany(
+        """
+        insert into submissions
+        values (?, '', '', '', '', ?, 1, ?, 0, 0, 0, 0, 0, 'query', 1)
+        """,
+        ((f"s{i}", f"/r/s{i}", BODY.format(i=i)) for i in range(n_submissions))
+    )
+    conn.commit()
+    conn.close()
+
+def run(path: str, chunk_size: int, workers: int, parser: str) -> float:
+    conn = sqlite3.connect(path)
+    conn.execute("delete from medias")
+    conn.execute("delete from links_extracted")
+    conn.commit()
+
+    start = perf_counter()
+    ingest(conn.cursor(), chunk_size, workers, parser)
+    elapsed = perf_counter() - start
+
+    conn.close()
+    return elapsed
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", "--submissions", type=int, default=100_000)
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    parser.add_argument("-w", "--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument(
+        "-p",
+        "--parsers",
+        choices=sorted(ANCHOR_PARSERS),
+        nargs="+",
+        default=sorted(ANCHOR_PARSERS),
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "bench.db")
+        make_corpus(path, args.submissions)
+
+        baseline = None
+        for name in args.parsers:
+            for workers in args.workers:
+                elapsed = run(path, args.chunk_size, workers, name)
+                if baseline is None:
+                    baseline = elapsed
+                rate = args.submissions / elapsed
+                speedup = baseline / elapsed
+                print(
+                    f"{name:>6}, {workers:>3} worker(s): "
+                    f"{rate:>10,.0f} posts/sec, {speedup:.2f}x"
+                )
+
+
+if __name__ == "__main__":
+    main()
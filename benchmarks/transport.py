@@ -0,0 +1,68 @@
+"""Compare per-request latency with and without a shared session.
+
+Requests are made against a local stand-in server, which supports
+keep-alive. Run from the repository root with
+`python -m benchmarks.transport`.
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from time import perf_counter
+from typing import Callable
+import argparse
+import requests
+
+from src.scrape.transport import make_session
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Buffer responses, so headers and body go out in one write - else
+    # Nagle's algorithm stalls kept-alive connections.
+    wbufsize = -1
+    body = b'{"data": {}}'
+
+    def do_GET(self) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, *args) -> None:
+        pass
+
+def start_server() -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def mean_latency_ms(get: Callable[[str], requests.Response], url: str, n: int) -> float:
+    start = perf_counter()
+    for _ in range(n):
+        get(url).raise_for_status()
+    return 1_000 * (perf_counter() - start) / n
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", "--requests", type=int, default=1_000)
+    args = parser.parse_args()
+
+    server = start_server()
+    host, port = server.server_address[:2]
+    url = f"http://{host}:{port}/"
+
+    session = make_session()
+    clients = (
+        ("requests.request", lambda u: requests.request("GET", u, timeout=60)),
+        ("shared session", lambda u: session.request("GET", u)),
+    )
+    for name, get in clients:
+        latency = mean_latency_ms(get, url, args.requests)
+        print(f"{name:>16}: {latency:.3f} ms/request")
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
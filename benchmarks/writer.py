@@ -0,0 +1,92 @@
+"""Compare row-at-a-time inserts against batched inserts.
+
+Run from the repository root with `python -m benchmarks.writer`.
+"""
+
+from dataclasses import asdict
+from time import perf_counter
+from typing import Callable, List
+import argparse
+import sqlite3
+
+from src.scrape.common import BulkWriter, insert_or_ignore
+from src.scrape.models import Submission
+from src.utils import migrate
+
+
+with open("src/sql/schema.sql") as fh:
+    setup_sql = fh.read()
+
+
+def make_submissions(n: int) -> List[Submission]:
+    return [
+        Submission(
+            id=f"s{i}",
+            title=f"Review {i}",
+            author_fullname="t2_author",
+            author="author",
+            subreddit="goodyearwelt",
+            permalink=f"/r/goodyearwelt/comments/s{i}/",
+            created_utc=1_500_000_000 + i,
+            selftext_html="&lt;p&gt;Some review text.&lt;/p&gt;",
+            num_comments=i % 50,
+            gilded=0,
+            downs=0,
+            ups=i % 100,
+            score=i % 100,
+            search_query="review",
+        )
+        for i in range(n)
+    ]
+
+def unbatched(cursor: sqlite3.Cursor, submissions: List[Submission]) -> None:
+    # The original `insert_or_ignore`, which rebuilds the statement per row.
+    for submission in submissions:
+        d = asdict(submission)
+        names, values = zip(*d.items())
+        targets = ', '.join(names)
+        params = ', '.join(["?" for _ in values])
+        sql = f"insert or ignore into submissions ({targets}) values ({params})"
+        cursor.execute(sql, values)
+
+def per_row(cursor: sqlite3.Cursor, submissions: List[Submission]) -> None:
+    for submission in submissions:
+        insert_or_ignore(cursor, "submissions", submission)
+
+def batched(cursor: sqlite3.Cursor, submissions: List[Submission]) -> None:
+    with BulkWriter(cursor, "submissions") as writer:
+        for submission in submissions:
+            writer.add(submission)
+
+def rows_per_second(fn: Callable, submissions: List[Submission]) -> float:
+    conn = sqlite3.connect(":memory:")
+    conn.executescript(setup_sql)
+    migrate(conn.cursor())
+    cursor = conn.cursor()
+
+    start = perf_counter()
+    fn(cursor, submissions)
+    conn.commit()
+    elapsed = perf_counter() - start
+
+    conn.close()
+    return len(submissions) / elapsed
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", "--rows", type=int, default=50_000, help="Rows to insert.")
+    args = parser.parse_args()
+
+    submissions = make_submissions(args.rows)
+    benchmarks = (
+        ("unbatched", unbatched),
+        ("insert_or_ignore", per_row),
+        ("BulkWriter", batched),
+    )
+    for name, fn in benchmarks:
+        rate = rows_per_second(fn, submissions)
+        print(f"{name:>16}: {rate:>12,.0f} rows/sec")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""Compare Zappos search with pages fetched serially and concurrently.
+
+Searches are made against a local stand-in for the Zappos search API,
+which takes `--latency-ms` to answer each page. Results are written to
+an in-memory database page by page, as `zappos.main --search` does. Run
+from the repository root with `python -m benchmarks.zappos_search`.
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from time import perf_counter, sleep
+from urllib.parse import parse_qsl, urlparse
+import argparse
+import json
+import sqlite3
+import tracemalloc
+
+from src.scrape.adaptive import AdaptiveLimit
+from src.scrape.common import BulkWriter
+from src.scrape.ratelimit import RateLimiter, TokenBucket, zappos_limit
+from src.scrape.transport import make_session
+from src.scrape.zappos import ZapposClient, iter_search_pages
+from src.utils import migrate
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    wbufsize = -1
+    total = 0
+    page_size = 0
+    latency = 0.0
+
+    def do_GET(self) -> None:
+        params = dict(parse_qsl(urlparse(self.path).query))
+        first = (int(params["page"]) - 1) * self.page_size
+        results = [
+            {
+                "brandName": "brand",
+                "productId": str(product_id),
+                "productName": f"product {product_id}",
+                "categoryFacet": "Boots",
+            }
+            for product_id in range(first, min(first + self.page_size, self.total))
+        ]
+        body = json.dumps({
+            "totalResultCount": str(self.total),
+            "status": "200",
+            "results": results,
+        }).encode()
+
+        sleep(self.latency)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args) -> None:
+        pass
+
+def start_server(total: int, page_size: int, latency: float) -> ThreadingHTTPServer:
+    Handler.total = total
+    Handler.page_size = page_size
+    Handler.latency = latency
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def run(base_url: str, workers: int) -> int:
+    # Don't let the default rate limit dominate the comparison.
+    limiter = RateLimiter(TokenBucket(rate=10_000, capacity=10_000), zappos_limit)
+    client = ZapposClient(
+        "api-key",
+        make_session(pool_size=max(workers, 1)),
+        limiter=limiter,
+        concurrency=AdaptiveLimit(maximum=max(workers, 1)),
+    )
+    client.base_url = base_url
+
+    conn = sqlite3.connect(":memory:")
+    with open("src/sql/schema.sql") as fh:
+        conn.executescript(fh.read())
+    cursor = conn.cursor()
+    migrate(cursor)
+
+    with BulkWriter(cursor, "searches") as writer:
+        for results in iter_search_pages(client, "boots", workers):
+            for result in results:
+                writer.add(result)
+    conn.commit()
+    conn.close()
+    return writer.count
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", "--results", type=int, default=20_000)
+    parser.add_argument("--page-size", type=int, default=500)
+    parser.add_argument("--latency-ms", type=float, default=50)
+    parser.add_argument("-w", "--workers", type=int, nargs="+", default=[1, 4, 8])
+    args = parser.parse_args()
+
+    server = start_server(args.results, args.page_size, args.latency_ms / 1_000)
+    host, port = server.server_address[:2]
+    base_url = f"http://{host}:{port}"
+
+    for workers in args.workers:
+        tracemalloc.start()
+        start = perf_counter()
+        n_written = run(base_url, workers)
+        elapsed = perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(
+            f"{workers:>3} workers: {n_written} results in {elapsed:.2f} s, "
+            f"peak {peak / 1024 / 1024:.1f} MB"
+        )
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
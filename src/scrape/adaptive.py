@@ -0,0 +1,124 @@
+"""Adapt the number of concurrent requests made to a host.
+
+The number of requests allowed in flight grows by one for every
+window of healthy responses, and is cut by a factor when a request
+fails, is throttled (429), errors server-side (5xx), or takes much
+longer than usual (additive increase, multiplicative decrease). The
+limit settles just below the point where the host starts to struggle.
+"""
+
+from time import monotonic
+from typing import Callable, Dict, Optional, TypeVar
+from urllib.parse import urlparse
+import logging
+import requests
+import threading
+
+
+DEFAULT_MAX_CONCURRENCY = 8
+R = TypeVar("R", bound=requests.Response)
+
+
+class AdaptiveLimit(object):
+    """Limit the number of requests in flight, adapting it with AIMD."""
+
+    def __init__(
+        self,
+        initial: int = 1,
+        minimum: int = 1,
+        maximum: int = DEFAULT_MAX_CONCURRENCY,
+        backoff: float = .5,
+        latency_tolerance: float = 2,
+        smoothing: float = .1,
+    ) -> None:
+        if not 1 <= minimum <= initial <= maximum:
+            raise ValueError("Must have 1 <= `minimum` <= `initial` <= `maximum`")
+
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.backoff = backoff
+        # A response slower than this many times the average is a sign
+        # of overload.
+        self.latency_tolerance = latency_tolerance
+        self.smoothing = smoothing
+        # Average latency of healthy responses.
+        self.latency: Optional[float] = None
+        self.in_flight = 0
+        self._decreased_at = monotonic()
+        self._condition = threading.Condition()
+
+    @property
+    def current(self) -> int:
+        return int(self.limit)
+
+    def acquire(self) -> float:
+        with self._condition:
+            self._condition.wait_for(lambda: self.in_flight < self.current)
+            self.in_flight += 1
+        return monotonic()
+
+    def is_overloaded(self, status: Optional[int], latency: float) -> bool:
+        if status is None or status == 429 or status >= 500:
+            return True
+        if self.latency is None:
+            return False
+        return latency > self.latency_tolerance * self.latency
+
+    def release(self, started: float, status: Optional[int]) -> None:
+        """Record the outcome of a request, started at `started`.
+
+        `status` is None if no response was received.
+        """
+        now = monotonic()
+        latency = now - started
+        with self._condition:
+            self.in_flight -= 1
+            if self.is_overloaded(status, latency):
+                # Requests which were already in flight when the limit was
+                # cut are likely to see the same overload, so only cut once.
+                if started >= self._decreased_at:
+                    self.limit = max(self.minimum, self.limit * self.backoff)
+                    self._decreased_at = now
+                    logging.debug("Decreased concurrency limit to %s", self.current)
+            else:
+                if self.latency is None:
+                    self.latency = latency
+                else:
+                    self.latency += self.smoothing * (latency - self.latency)
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+            self._condition.notify_all()
+
+    def call(self, request: Callable[[], R]) -> R:
+        started = self.acquire()
+        status = None
+        try:
+            response = request()
+            status = response.status_code
+            return response
+        finally:
+            self.release(started, status)
+
+class HostLimits(object):
+    """An adaptive concurrency limit for each host."""
+
+    def __init__(self, **kwds) -> None:
+        self.kwds = kwds
+        self.limits: Dict[str, AdaptiveLimit] = {}
+        self._lock = threading.Lock()
+
+    def get(self, url: str) -> AdaptiveLimit:
+        host = urlparse(url).netloc.lower()
+        with self._lock:
+            if host not in self.limits:
+                self.limits[host] = AdaptiveLimit(**self.kwds)
+            return self.limits[host]
+
+    def call(self, url: str, request: Callable[[], R]) -> R:
+        return self.get(url).call(request)
+
+    def metrics(self) -> Dict[str, int]:
+        # Current limit, by host.
+        with self._lock:
+            return {host: limit.current for host, limit in self.limits.items()}
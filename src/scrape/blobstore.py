@@ -0,0 +1,175 @@
+"""Move image content out of the database, into a blob store.
+
+Blobs are stored as files named by the SHA-256 digest of their content,
+sharded into nested directories by the digest's leading characters,
+e.g. `ab/cd/abcd...`. Identical content is only stored once, however
+many images have it. An image row keeps the digest in `img_digest`,
+with `img` left null.
+"""
+
+from hashlib import sha256
+from pathlib import Path
+from typing import List, Optional, Tuple, Union
+import logging
+import mmap
+import os
+import sqlite3
+import sys
+import tempfile
+
+from src.scrape.common import base_parser, setup_logging
+from src.scrape.models import Image
+from src.utils import migrate
+
+
+# Images to move out of the database between commits.
+MIGRATE_BATCH_SIZE = 100
+
+
+def sync_directory(path: Path) -> None:
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class BlobStore(object):
+    # Shard by two levels of two hex characters, for 65,536 directories.
+    levels = 2
+    width = 2
+
+    def __init__(self, root: Union[str, Path]) -> None:
+        self.root = Path(root)
+
+    def path(self, digest: str) -> Path:
+        shards = [
+            digest[i * self.width:(i + 1) * self.width]
+            for i in range(self.levels)
+        ]
+        return self.root.joinpath(*shards, digest)
+
+    def __contains__(self, digest: str) -> bool:
+        return self.path(digest).exists()
+
+    def put(self, data: bytes) -> str:
+        digest = sha256(data).hexdigest()
+        path = self.path(digest)
+        if path.exists():
+            return digest
+
+        # Write to a temporary file first, so that a blob is never seen
+        # partially written. Both the content and its name are synced to
+        # disk before returning, as rows pointing to the blob may be
+        # committed, and the original content dropped, straight after.
+        shards = [path.parents[i] for i in range(self.levels)]
+        new_shards = [shard for shard in shards if not shard.exists()]
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as fh:
+                fh.write(data)
+                fh.flush()
+                os.fsync(fh.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+        # New shard directories have to be synced into their parents too.
+        for directory in [path.parent, *(shard.parent for shard in new_shards)]:
+            sync_directory(directory)
+        return digest
+
+    def get(self, digest: str) -> bytes:
+        return self.path(digest).read_bytes()
+
+    def open(self, digest: str) -> Union[mmap.mmap, bytes]:
+        """Memory-map a blob, read-only.
+
+        Empty blobs cannot be mapped, and are returned as `bytes`.
+        """
+        with open(self.path(digest), "rb") as fh:
+            if os.fstat(fh.fileno()).st_size == 0:
+                return b""
+            return mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+def store_image(store: Optional[BlobStore], image: Image) -> Image:
+    # Swap the image's content for its digest.
+    if store is None or image.img is None:
+        return image
+
+    image.img_digest = store.put(image.img)
+    image.img = None
+    return image
+
+def unmigrated_images(cursor: sqlite3.Cursor, limit: int) -> List[Tuple[int, bytes]]:
+    cursor.execute(
+        """
+        select rowid, img
+        from images
+        where img is not null
+        limit ?
+        """,
+        (limit,)
+    )
+    return cursor.fetchall()
+
+def migrate_images(cursor: sqlite3.Cursor, store: BlobStore, batch_size: int = MIGRATE_BATCH_SIZE) -> int:  # noqa: E501
+    n_migrated = 0
+    while True:
+        records = unmigrated_images(cursor, batch_size)
+        if not records:
+            break
+
+        # Write blobs before the rows which point to them are committed.
+        updates = [(store.put(img), rowid) for rowid, img in records]
+        cursor.executemany(
+            "update images set img_digest = ?, img = null where rowid = ?",
+            updates
+        )
+        cursor.connection.commit()
+
+        n_migrated += len(updates)
+        logging.info("Moved %s images", n_migrated)
+
+    return n_migrated
+
+def main() -> int:
+    setup_logging()
+    parser = base_parser(description=__doc__)
+    parser.add_argument("-r", "--root", required=True, type=str, help="Blob store root.")
+    parser.add_argument(
+        "--vacuum",
+        action="store_true",
+        help="Reclaim the space freed in the database afterwards.",
+    )
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.conn)
+    cursor = conn.cursor()
+    logging.info("Established database connection")
+    migrate(cursor)
+
+    store = BlobStore(args.root)
+
+    status = 0
+    try:
+        migrate_images(cursor, store)
+        if args.vacuum:
+            logging.info("Vacuuming database")
+            cursor.execute("vacuum")
+    except (sqlite3.Error, OSError) as e:
+        logging.error("Encountered error, aborting: %s", e)
+        conn.rollback()
+        status = 1
+    else:
+        conn.commit()
+    finally:
+        conn.close()
+        logging.info("Finished moving images")
+
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,63 @@
+"""Conversion of models to database rows, and from API responses.
+
+Codecs are compiled once per model class.
+
+Encoders read field values directly off of an instance and pass them
+through as-is, skipping the per-row dict and `deepcopy` traversal of
+`dataclasses.asdict`/`astuple`. Neither copies `bytes` payloads, which
+`deepcopy` treats as immutable, but `deepcopy` fails outright on
+`memoryview` payloads, which encoders pass through like any other value.
+
+Decoders build an instance from an API response, picking out the
+model's init fields (including `InitVar`s) by name, with missing keys
+defaulting to `None`. Renames and other derived fields are then
+handled by the model's `__post_init__`, as usual.
+"""
+
+from dataclasses import fields
+from functools import lru_cache
+from operator import attrgetter
+from typing import Any, Callable, Dict, Mapping, Tuple
+
+
+Row = Tuple[Any, ...]
+
+
+@lru_cache(maxsize=None)
+def field_names(cls: type) -> Tuple[str, ...]:
+    return tuple(f.name for f in fields(cls))
+
+@lru_cache(maxsize=None)
+def encoder(cls: type) -> Callable[[Any], Row]:
+    names = field_names(cls)
+    getter = attrgetter(*names)
+    if len(names) == 1:
+        # `attrgetter` only returns a tuple when given multiple names.
+        return lambda instance: (getter(instance),)
+    return getter
+
+def to_row(instance: Any) -> Row:
+    # Annotated, as mypy doesn't see `type(...)` as hashable for the cache.
+    cls: type = type(instance)
+    return encoder(cls)(instance)
+
+@lru_cache(maxsize=None)
+def init_field_names(cls: type) -> Tuple[str, ...]:
+    dataclass_fields = getattr(cls, "__dataclass_fields__")
+    return tuple(f.name for f in dataclass_fields.values() if f.init)
+
+@lru_cache(maxsize=None)
+def decoder(cls: type) -> Callable[[Mapping[str, Any]], Any]:
+    # Generate the equivalent of
+    # `cls(**{name: data.get(name) for name in init_field_names(cls)})`,
+    # with the field names unrolled.
+    kwds = ", ".join(f"{name}=get({name!r})" for name in init_field_names(cls))
+    source = "\n".join([
+        "def decode(data):",
+        "    get = data.get",
+        f"    return cls({kwds})",
+    ])
+    namespace: Dict[str, Any] = {"cls": cls}
+    exec(source, namespace)
+    decode: Callable[[Mapping[str, Any]], Any] = namespace["decode"]
+    return decode
@@ -1,30 +1,159 @@
-from dataclasses import asdict
-from typing import Callable, TypeVar
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Executor, Future, ThreadPoolExecutor, wait
+from functools import lru_cache
+from typing import Any, Callable, Deque, Dict, Iterable, Iterator, List, Optional, Set, TypeVar  # noqa: E501
 from urllib.parse import urlparse
 import argparse
 import logging
+import resource
 import sqlite3
 import sys
 
+from src.scrape.codecs import Row, decoder, encoder, field_names, to_row
+
 
 PLACEHOLDER = "?"
+DEFAULT_BATCH_SIZE = 500
 T = TypeVar("T")
+R = TypeVar("R")
 
 
 def from_json(cls: Callable[..., T], **data) -> T:
-    fields = getattr(cls, "__dataclass_fields__")
-    init_field_names = [f.name for f in fields.values() if f.init]
-    kwds = {name: data.get(name) for name in init_field_names}
-    return cls(**kwds)
+    decode: Callable[[Dict[str, Any]], T] = decoder(cls)  # type: ignore
+    return decode(data)
 
-def insert_or_ignore(cursor: sqlite3.Cursor, table: str, instance: object) -> None:
-    d = asdict(instance)
-    names, values = zip(*d.items())
+@lru_cache(maxsize=None)
+def insert_statement(table: str, cls: type) -> str:
+    names = field_names(cls)
     targets = ', '.join(names)
-    params = ', '.join([PLACEHOLDER for _ in values])
+    params = ', '.join([PLACEHOLDER for _ in names])
+    return f"insert or ignore into {table} ({targets}) values ({params})"
+
+def insert_or_ignore(cursor: sqlite3.Cursor, table: str, instance: object) -> None:
+    cls: type = type(instance)
+    sql = insert_statement(table, cls)
+    cursor.execute(sql, to_row(instance))
+    return
+
+class BulkWriter(object):
+    """Buffer model instances for a table and insert them in batches.
+
+    Rows are written with `insert or ignore` semantics, same as
+    `insert_or_ignore`, once `batch_size` instances have been added,
+    when `flush` is called, or when leaving the writer's context.
+    """
+
+    def __init__(self, cursor: sqlite3.Cursor, table: str, batch_size: int = DEFAULT_BATCH_SIZE) -> None:  # noqa: E501
+        if batch_size < 1:
+            raise ValueError("`batch_size` must be positive")
+
+        self.cursor = cursor
+        self.table = table
+        self.batch_size = batch_size
+        self.count = 0
+        self._cls: Optional[type] = None
+        self._encode: Callable[[object], Row] = to_row
+        self._rows: List[Row] = []
+
+    def __enter__(self) -> "BulkWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        # Keep buffered rows on non-database errors, so that callers
+        # which commit partial progress don't lose them.
+        if exc_type is None or not issubclass(exc_type, sqlite3.Error):
+            self.flush()
+
+    def add(self, instance: object) -> None:
+        cls: type = type(instance)
+        if self._cls is None:
+            self._cls = cls
+            self._encode = encoder(cls)
+        elif cls is not self._cls:
+            raise TypeError(f"Expected {self._cls.__name__}, got {cls.__name__}")
+
+        self._rows.append(self._encode(instance))
+        if len(self._rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self._rows or self._cls is None:
+            return
+
+        sql = insert_statement(self.table, self._cls)
+        self.cursor.executemany(sql, self._rows)
+        self.count += len(self._rows)
+        self._rows = []
+
+def completed_results(done: Iterable["Future[R]"]) -> Iterator[R]:
+    # Yield every successful result before raising the first error,
+    # so that completed work is not discarded.
+    error: Optional[BaseException] = None
+    for future in done:
+        exception = future.exception()
+        if exception is None:
+            yield future.result()
+        elif error is None:
+            error = exception
+
+    if error is not None:
+        raise error
+    return
+
+def concurrent_map(fn: Callable[[T], R], items: Iterable[T], workers: int) -> Iterator[R]:  # noqa: E501
+    """Map `fn` over `items` on a pool of `workers` threads.
+
+    Results are yielded in the order they complete, and at most
+    `2 * workers` items are in flight at once, so `items` may be a long,
+    lazy iterable. If `fn` raises, the exception is re-raised to the
+    caller and items which have not been started yet are dropped.
+    """
+    if workers <= 1:
+        yield from map(fn, items)
+        return
+
+    max_pending = 2 * workers
+    pending: Set["Future[R]"] = set()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            for item in items:
+                pending.add(executor.submit(fn, item))
+                if len(pending) < max_pending:
+                    continue
+
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                yield from completed_results(done)
+
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                yield from completed_results(done)
+        finally:
+            for future in pending:
+                future.cancel()
+
+    return
+
+def ordered_map(executor: Executor, fn: Callable[[T], R], items: Iterable[T], max_pending: int) -> Iterator[R]:  # noqa: E501
+    """Map `fn` over `items` on `executor`, yielding results in order.
+
+    Unlike `Executor.map`, at most `max_pending` items are submitted but
+    not yet yielded at once, so `items` may be a long, lazy iterable and
+    finished results are not held on to. If `fn` raises, the exception
+    is re-raised to the caller and pending items are cancelled.
+    """
+    pending: Deque["Future[R]"] = deque()
+    try:
+        for item in items:
+            pending.append(executor.submit(fn, item))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
 
-    sql = f"insert or ignore into {table} ({targets}) values ({params})"
-    cursor.execute(sql, values)
     return
 
 def is_media_url(url: str) -> bool:
@@ -37,6 +166,10 @@ def is_media_url(url: str) -> bool:
     is_reddit = domain.endswith("redd.it") or domain.endswith("reddituploads.com")
     return is_imgur or is_reddit
 
+def peak_memory_mb() -> float:
+    # Linux reports the maximum resident set size in kilobytes.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
 def setup_logging() -> None:
     logging.basicConfig(
         stream=sys.stdout,
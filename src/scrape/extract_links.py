@@ -1,63 +1,258 @@
 """Extract image links from submission bodies."""
 
 from bs4 import BeautifulSoup
-from itertools import chain, starmap
-from typing import List, Tuple
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from html.parser import HTMLParser
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
 import html
 import logging
 import sqlite3
 import sys
 
-from src.scrape.common import base_parser, insert_or_ignore, is_media_url, setup_logging
+from src.scrape.common import (
+    BulkWriter,
+    base_parser,
+    is_media_url,
+    ordered_map,
+    peak_memory_mb,
+    setup_logging,
+)
 from src.scrape.models import Media
+from src.utils import migrate
 
 
-def get_submission_contents(cursor: sqlite3.Cursor) -> List[Tuple[str, str]]:
+# Number of submissions to read, and commit the links of, at a time.
+CHUNK_SIZE = 1_000
+# Condition for submissions which have a body that has not been
+# searched for links yet.
+UNPROCESSED = """
+    selftext_html is not null
+    and id not in (select submission_id from links_extracted)
+"""
+
+
+def iter_submission_contents(cursor: sqlite3.Cursor, chunk_size: int) -> Iterator[List[Tuple[str, str]]]:  # noqa: E501
     cursor.execute(
-        """
+        f"""
         select
             id,
             selftext_html
         from submissions
-        where selftext_html is not null
+        where {UNPROCESSED}
         """
     )
-    return cursor.fetchall()
+    while True:
+        records = cursor.fetchmany(chunk_size)
+        if not records:
+            break
+        yield records
 
-def extract(submission_id: str, selftext_html: str) -> List[Media]:
-    raw = html.unescape(selftext_html)
+    return
+
+def mark_processed(cursor: sqlite3.Cursor, submission_ids: List[str]) -> None:
+    cursor.executemany(
+        "insert or ignore into links_extracted (submission_id) values (?)",
+        [(submission_id,) for submission_id in submission_ids]
+    )
+    return
+
+def rowid_ranges(cursor: sqlite3.Cursor, chunk_size: int) -> List[Tuple[int, int]]:
+    cursor.execute(f"select min(rowid), max(rowid) from submissions where {UNPROCESSED}")
+    start, stop = cursor.fetchone()
+    if start is None:
+        return []
+    return [
+        (lower, min(lower + chunk_size - 1, stop))
+        for lower in range(start, stop + 1, chunk_size)
+    ]
+
+def database_path(cursor: sqlite3.Cursor) -> str:
+    cursor.execute("pragma database_list")
+    for _, name, path in cursor.fetchall():
+        if name == "main":
+            return str(path)
+    return ""
+
+class AnchorParser(HTMLParser):
+    """Collect the href and text of anchors, without building a tree."""
+
+    def __init__(self) -> None:
+        super().__init__(convert_charrefs=True)
+        # Anchors as (href, text fragments), in document order.
+        self.anchors: List[Tuple[str, List[str]]] = []
+        self._open: List[List[str]] = []
+
+    def handle_starttag(self, tag: str, attrs: List[Tuple[str, Optional[str]]]) -> None:
+        if tag != "a":
+            return
+
+        href = dict(attrs).get("href")
+        fragments: List[str] = []
+        # Keep track of anchors without a link, as they may be nested.
+        if href is not None:
+            self.anchors.append((href, fragments))
+        self._open.append(fragments)
+
+    def handle_endtag(self, tag: str) -> None:
+        if tag == "a" and self._open:
+            self._open.pop()
+
+    def handle_data(self, data: str) -> None:
+        # Text belongs to every enclosing anchor.
+        for fragments in self._open:
+            fragments.append(data)
+
+def soup_anchors(raw: str) -> List[Tuple[str, str]]:
     soup = BeautifulSoup(raw, "html.parser")
-    links = soup.find_all("a")
+    links = soup.find_all("a", href=True)
+    # `href` is not a multi-valued attribute, so is always a string.
+    return [(str(link.attrs["href"]), link.text) for link in links]
+
+def parser_anchors(raw: str) -> List[Tuple[str, str]]:
+    parser = AnchorParser()
+    parser.feed(raw)
+    parser.close()
+    return [(href, "".join(fragments)) for href, fragments in parser.anchors]
+
+ANCHOR_PARSERS: Dict[str, Callable[[str], List[Tuple[str, str]]]] = {
+    "soup": soup_anchors,
+    "stdlib": parser_anchors,
+}
+DEFAULT_PARSER = "soup"
+
+def extract(submission_id: str, selftext_html: str, parser: str = DEFAULT_PARSER) -> List[Media]:  # noqa: E501
+    raw = html.unescape(selftext_html)
+    anchors = ANCHOR_PARSERS[parser](raw)
 
     medias = [
         Media(
             submission_id=submission_id,
-            url=link.attrs["href"],
+            url=href,
             # Link was found in post body, not metadata, so it is "indirect".
             is_direct=False,
-            txt=link.text
+            txt=txt
         )
-        for link in links
-        if is_media_url(link.attrs["href"])
+        for href, txt in anchors
+        if is_media_url(href)
     ]
     return medias
 
+def extract_all(records: List[Tuple[str, str]], parser: str = DEFAULT_PARSER) -> Tuple[List[str], List[Media]]:  # noqa: E501
+    medias = [
+        media
+        for submission_id, selftext_html in records
+        for media in extract(submission_id, selftext_html, parser)
+    ]
+    submission_ids = [submission_id for submission_id, _ in records]
+    return submission_ids, medias
+
+def extract_range(database: str, parser: str, bounds: Tuple[int, int]) -> Tuple[List[str], List[Media]]:  # noqa: E501
+    # Runs in a worker process, so has to get its own connection.
+    conn = sqlite3.connect(database)
+    try:
+        cursor = conn.execute(
+            f"""
+            select
+                id,
+                selftext_html
+            from submissions
+            where
+                rowid between ? and ?
+                and {UNPROCESSED}
+            """,
+            bounds
+        )
+        records = cursor.fetchall()
+    finally:
+        conn.close()
+
+    return extract_all(records, parser)
+
+def ingest_parallel(cursor: sqlite3.Cursor, chunk_size: int, workers: int, parser: str) -> int:  # noqa: E501
+    # Workers parse rowid ranges of submissions, and send back their links
+    # to be written from this process, which is the only writer.
+    database = database_path(cursor)
+    if not database:
+        raise ValueError("Parallel extraction requires an on-disk database")
+
+    # Only a few ranges are submitted ahead of the writer, so that the
+    # links waiting to be written stay bounded.
+    ranges = rowid_ranges(cursor, chunk_size)
+    n_processed = 0
+    writer = BulkWriter(cursor, "medias")
+    with ProcessPoolExecutor(max_workers=workers) as executor, writer:
+        extract_ = partial(extract_range, database, parser)
+        results = ordered_map(executor, extract_, ranges, max_pending=2 * workers)
+        for submission_ids, medias in results:
+            for media in medias:
+                writer.add(media)
+
+            writer.flush()
+            mark_processed(cursor, submission_ids)
+            cursor.connection.commit()
+            n_processed += len(submission_ids)
+            logging.info("Processed %s submissions", n_processed)
+
+    return n_processed
+
+def ingest(cursor: sqlite3.Cursor, chunk_size: int = CHUNK_SIZE, workers: int = 1, parser: str = DEFAULT_PARSER) -> int:  # noqa: E501
+    if workers > 1:
+        return ingest_parallel(cursor, chunk_size, workers, parser)
+
+    # Submissions are read with a cursor of their own, so that they can
+    # be streamed while links are written, and committed, with `cursor`.
+    # Links and the submissions they were found in are committed together,
+    # so only new submissions are read on the next run.
+    read_cursor = cursor.connection.cursor()
+    n_processed = 0
+    with BulkWriter(cursor, "medias") as writer:
+        for records in iter_submission_contents(read_cursor, chunk_size):
+            for submission_id, selftext_html in records:
+                for media in extract(submission_id, selftext_html, parser):
+                    writer.add(media)
+
+            writer.flush()
+            mark_processed(cursor, [submission_id for submission_id, _ in records])
+            cursor.connection.commit()
+            n_processed += len(records)
+            logging.info("Processed %s submissions", n_processed)
+
+    return n_processed
+
 def main() -> int:
     setup_logging()
     parser = base_parser(description=__doc__)
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=CHUNK_SIZE,
+        help="Number of submissions to process between commits.",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes to parse submissions with.",
+    )
+    parser.add_argument(
+        "-p",
+        "--parser",
+        choices=sorted(ANCHOR_PARSERS),
+        default=DEFAULT_PARSER,
+        help="HTML parser to extract links with.",
+    )
     args = parser.parse_args()
 
     conn = sqlite3.connect(args.conn)
     cursor = conn.cursor()
     logging.info("Established database connection")
+    migrate(cursor)
 
     status = 0
     try:
-        records = get_submission_contents(cursor)
-        g = chain.from_iterable(starmap(extract, records))
-        medias = list(g)
-        for media in medias:
-            insert_or_ignore(cursor, "medias", media)
+        ingest(cursor, args.chunk_size, args.workers, args.parser)
     except sqlite3.Error as e:
         logging.error("Encountered error, aborting: %s", e)
         conn.rollback()
@@ -66,7 +261,7 @@ def main() -> int:
         conn.commit()
     finally:
         conn.close()
-        logging.info("Finished extracting links")
+        logging.info("Finished extracting links, peak memory %.1f MB", peak_memory_mb())
 
     return status
 
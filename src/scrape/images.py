@@ -1,26 +1,96 @@
 """Get linked images and album metadata."""
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
 from pathlib import Path
-from typing import Any, Dict, List, MutableMapping, Optional, Tuple
+from typing import Any, Dict, Iterator, List, MutableMapping, Optional, Tuple
 from urllib.parse import urlparse, urlunparse
 import logging
 import requests
 import sqlite3
 import sys
-
-from src.scrape.common import base_parser, from_json, insert_or_ignore, setup_logging
+import threading
+
+from src.scrape.adaptive import HostLimits
+from src.scrape.blobstore import BlobStore, store_image
+from src.scrape.common import (
+    BulkWriter,
+    base_parser,
+    concurrent_map,
+    from_json,
+    insert_or_ignore,
+    setup_logging,
+)
 from src.scrape.models import Album, Image
+from src.scrape.ratelimit import RateLimiter, shared_limiter
+from src.scrape.transport import (
+    DEFAULT_POOL_SIZE,
+    add_arguments,
+    default_session,
+    make_session,
+)
+from src.utils import migrate
 
 
 IMGUR_API_VERSION = 3
+# Images carry their content, so keep batches small.
+IMAGE_BATCH_SIZE = 10
+# Maximum size of an album's downloaded, but not yet written, images.
+MAX_ALBUM_BYTES = 64 * 1024 * 1024
 
 
 class RateLimitError(Exception):
     pass
 
+# Errors which stop an ingest, but keep the progress made so far. Reads
+# which time out on every retry are raised as a `ConnectionError`.
+TRANSIENT_ERRORS = (RateLimitError, requests.Timeout, requests.ConnectionError)
+
+class ByteBudget(object):
+    """Limit the number of bytes held at once, across threads."""
+
+    def __init__(self, limit: int) -> None:
+        self.limit = limit
+        self.in_flight = 0
+        self.closed = False
+        self._condition = threading.Condition()
+
+    def acquire(self, n_bytes: int) -> None:
+        # Something that is larger than the limit by itself is let
+        # through once nothing else is held, rather than waiting forever.
+        def has_room() -> bool:
+            if self.closed or self.in_flight == 0:
+                return True
+            return self.in_flight + n_bytes <= self.limit
+
+        with self._condition:
+            self._condition.wait_for(has_room)
+            self.in_flight += n_bytes
+
+    def release(self, n_bytes: int) -> None:
+        with self._condition:
+            self.in_flight -= n_bytes
+            self._condition.notify_all()
+
+    def adjust(self, n_bytes: int) -> None:
+        # Account for bytes which are already held, without waiting.
+        with self._condition:
+            self.in_flight += n_bytes
+            self._condition.notify_all()
+
+    def close(self) -> None:
+        # Stop blocking, e.g. when nothing will be released anymore.
+        with self._condition:
+            self.closed = True
+            self._condition.notify_all()
+
 class Client(object):
     fail_on_statuses = (401, 403)
-    timeout = 60
+
+    def __init__(self, session: Optional[requests.Session] = None, limits: Optional[HostLimits] = None) -> None:  # noqa: E501
+        self.session = session or default_session()
+        # Number of requests to make to each host at once.
+        self.limits = limits or HostLimits()
 
     @property
     def headers(self) -> Optional[Dict[str, str]]:
@@ -38,12 +108,8 @@ class Client(object):
         )
 
     def get_image(self, url: str, **metadata) -> Image:
-        response = requests.request(
-            "GET",
-            url,
-            headers=self.headers,
-            timeout=self.timeout
-        )
+        request = partial(self.session.request, "GET", url, headers=self.headers)
+        response = self.limits.call(url, request)
         if not response.ok:
             self.on_failure(response)
             logging.warning("Returning image for %s as only metadata", url)
@@ -61,9 +127,18 @@ class Client(object):
 
 class ImgurClient(Client):
     min_stopping_credits = 3
+    # Longest to wait for the rate limit before stopping.
+    max_wait_seconds = 60
 
-    def __init__(self, client_id: str) -> None:
+    def __init__(self, client_id: str, session: Optional[requests.Session] = None, album_concurrency: int = 1, limiter: Optional[RateLimiter] = None, limits: Optional[HostLimits] = None) -> None:  # noqa: E501
+        super().__init__(session, limits)
         self.client_id = client_id
+        self.limiter = limiter or shared_limiter("imgur", client_id)
+        # Number of an album's images to download at once.
+        self.album_concurrency = album_concurrency
+        # Shared by all threads using the client, so that once one of them
+        # is stopped by the rate limit, the others stop too.
+        self.rate_limited = threading.Event()
 
     @property
     def headers(self) -> Dict[str, str]:
@@ -78,9 +153,17 @@ class ImgurClient(Client):
 
         return hit_threshold("User") or hit_threshold("Client")
 
+    def stop(self, reason: str) -> None:
+        self.rate_limited.set()
+        raise RateLimitError(reason)
+
+    def check_stopped(self) -> None:
+        if self.rate_limited.is_set():
+            raise RateLimitError("Stopped by an earlier request")
+
     def on_failure(self, response: requests.Response) -> None:
         if response.status_code == 429:
-            raise RateLimitError("Rate limited by Imgur")
+            self.stop("Rate limited by Imgur")
 
         super().on_failure(response)
         return None
@@ -92,12 +175,19 @@ class ImgurClient(Client):
         #
         # XXX: `url` cannot be a request to the API (eg
         # `api.imgur.com/3/image/{hash}`) or this will fail.
+        self.check_stopped()
         url = strip_imgur_subdomain(url)
         return super().get_image(url, **metadata)
 
     def get_json(self, url: str) -> Optional[Any]:
+        self.check_stopped()
+        if not self.limiter.acquire(timeout=self.max_wait_seconds):
+            self.stop("Rate limit would be exceeded")
+
         headers = {**self.headers, "Accept": "application/json"}
-        response = requests.request("GET", url, headers=headers, timeout=self.timeout)
+        request = partial(self.session.request, "GET", url, headers=headers)
+        response = self.limits.call(url, request)
+        self.limiter.update(response.headers)
         if not response.ok:
             self.on_failure(response)
             return None
@@ -105,25 +195,94 @@ class ImgurClient(Client):
         # Check if we're near to the rate limit - if it is hit too many
         # times, Imgur will penalize the client account.
         if self.near_rate_limit(response.headers):
-            raise RateLimitError(f"Stopping before rate limit reached")
+            self.stop("Stopping before rate limit reached")
 
         return response.json()
 
-    def get_album(self, url: str, media_id: int) -> Optional[Tuple[Album, List[Image]]]:
+    def get_album_json(self, url: str, media_id: int) -> Optional[Tuple[Album, List[Dict[str, Any]]]]:  # noqa: E501
         wrapped: Optional[Dict[str, Any]] = self.get_json(url)
         if wrapped is None:
             return None
 
         data = wrapped["data"]
         album = from_json(Album, **data, media_id=media_id)
-        images = []
-        for img in data["images"]:
-            img_url: str = img["link"]
-            metadata = {**img, "album_id": album.id, "media_id": media_id}
-            image = self.get_image(img_url, **metadata)
-            images.append(image)
+        return album, data["images"]
+
+    def get_album_image(self, album: Album, img: Dict[str, Any]) -> Image:
+        img_url: str = img["link"]
+        metadata = {**img, "album_id": album.id, "media_id": album.media_id}
+        return self.get_image(img_url, **metadata)
+
+    def get_album(self, url: str, media_id: int) -> Optional[Tuple[Album, List[Image]]]:
+        ret = self.get_album_json(url, media_id)
+        if ret is None:
+            return None
+
+        album, imgs = ret
+        # `map` keeps the images in album order.
+        with ThreadPoolExecutor(max_workers=self.album_concurrency) as executor:
+            images = list(executor.map(partial(self.get_album_image, album), imgs))
         return album, images
 
+    def iter_album_images(self, album: Album, imgs: List[Dict[str, Any]], max_bytes: int) -> Iterator[Image]:  # noqa: E501
+        budget = ByteBudget(max_bytes)
+
+        def download(img: Dict[str, Any]) -> Image:
+            # Reserve room for the image before downloading it.
+            reserved = img.get("size") or 0
+            budget.acquire(reserved)
+            try:
+                image = self.get_album_image(album, img)
+            except BaseException:
+                budget.release(reserved)
+                raise
+
+            # Imgur's size may be missing, or not that of the content.
+            budget.adjust(len(image.img or b"") - reserved)
+            return image
+
+        executor = ThreadPoolExecutor(max_workers=self.album_concurrency)
+        futures = {executor.submit(download, img) for img in imgs}
+        try:
+            for future in as_completed(futures):
+                # Don't hold on to the image through its future.
+                futures.remove(future)
+                image = future.result()
+                del future
+                # The caller may replace the content, e.g. with a digest.
+                n_bytes = len(image.img or b"")
+                try:
+                    yield image
+                finally:
+                    # The caller is done with the image once it asks
+                    # for the next one.
+                    budget.release(n_bytes)
+        finally:
+            budget.close()
+            for future in futures:
+                future.cancel()
+            executor.shutdown()
+
+    def stream_album(self, url: str, media_id: int, max_bytes: int = MAX_ALBUM_BYTES) -> Optional[Tuple[Album, Iterator[Image]]]:  # noqa: E501
+        """Get an album, and its images as they are downloaded.
+
+        Images are yielded in the order their downloads complete, which
+        may differ from the album's order. Room for each image is
+        reserved before it is downloaded, using the size Imgur reports
+        for it, and downloads wait while the images which are being
+        downloaded, or have been but are not yet consumed, would take up
+        more than `max_bytes`. Images with no reported size are only
+        counted once downloaded, so these can take the total over
+        `max_bytes` by up to `album_concurrency` times the largest of
+        them.
+        """
+        ret = self.get_album_json(url, media_id)
+        if ret is None:
+            return None
+
+        album, imgs = ret
+        return album, self.iter_album_images(album, imgs, max_bytes)
+
 def sniff_imgur_resource(url: str) -> Optional[str]:
     parsed = urlparse(url)
     # Filter in case there is a trailing slash.
@@ -177,16 +336,61 @@ def is_album(url: str) -> bool:
     resource_type = sniff_imgur_resource(url)
     return resource_type in ("album", "gallery")
 
+def canonical_media_key(url: str) -> str:
+    # Different forms of a url to the same resource, e.g.
+    # `i.imgur.com/x.jpg`, `m.imgur.com/x` and `imgur.com/x#anchor`,
+    # have the same key. Urls of an unknown form are their own key.
+    parsed = urlparse(url)
+    if not [slug for slug in parsed.path.split("/") if slug]:
+        return url
+
+    hash_ = get_id(url)
+    if is_imgur(url):
+        resource_type = sniff_imgur_resource(strip_imgur_subdomain(url))
+        if resource_type is None:
+            return url
+        return f"imgur/{resource_type}/{hash_}"
+
+    return f"{parsed.netloc.lower()}/{hash_}"
+
+def assign_canonical_keys(cursor: sqlite3.Cursor) -> None:
+    cursor.execute("select id, url from medias where canonical_key is null")
+    keys = [(canonical_media_key(url), media_id) for media_id, url in cursor.fetchall()]
+    cursor.executemany("update medias set canonical_key = ? where id = ?", keys)
+    return
+
 def get_links(cursor: sqlite3.Cursor) -> List[Tuple[int, str]]:
+    """Get one media for each resource which has not been fetched yet.
+
+    Medias are grouped by their canonical key, so each resource is
+    only fetched once, through its earliest media. A resource has been
+    fetched once it has an album row, which is written after all of the
+    album's images, or a standalone image.
+    """
+    assign_canonical_keys(cursor)
     cursor.execute(
         """
-        select id, url from medias
-        where id not in (select media_id from images)
+        select min(id), url
+        from medias
+        where canonical_key not in (
+            select m.canonical_key
+            from albums as a
+            inner join medias as m
+            on a.media_id = m.id
+            union
+            select m.canonical_key
+            from images as i
+            inner join medias as m
+            on i.media_id = m.id
+            where i.album_id is null
+        )
+        group by canonical_key
+        order by min(id)
         """
     )
     return cursor.fetchall()
 
-def ingest_albums(cursor: sqlite3.Cursor, client: ImgurClient, medias: List[Tuple[int, str]]) -> None:  # noqa: E501
+def ingest_albums(cursor: sqlite3.Cursor, client: ImgurClient, medias: List[Tuple[int, str]], max_bytes: int = MAX_ALBUM_BYTES, store: Optional[BlobStore] = None) -> None:  # noqa: E501
     for media_id, url in medias:
         hash_ = get_id(url)
         if hash_ is None:
@@ -194,54 +398,107 @@ def ingest_albums(cursor: sqlite3.Cursor, client: ImgurClient, medias: List[Tupl
             continue
 
         api_url = make_imgur_url("album", hash_)
-        ret = client.get_album(api_url, media_id)
+        ret = client.stream_album(api_url, media_id, max_bytes)
         if ret is None:
             continue
 
+        # Write images one at a time as they arrive, rather than batching
+        # them, so that they can be let go of as soon as possible. The
+        # album is written within a savepoint, so that an album which is
+        # interrupted part way through, e.g. by the rate limit, is not
+        # kept half written when progress is saved.
         album, images = ret
-        insert_or_ignore(cursor, "albums", album)
-        for image in images:
-            insert_or_ignore(cursor, "images", image)
+        if not cursor.connection.in_transaction:
+            cursor.execute("begin")
+        cursor.execute("savepoint album")
+        try:
+            for image in images:
+                insert_or_ignore(cursor, "images", store_image(store, image))
+            # The album row marks the album as complete, so write it last.
+            insert_or_ignore(cursor, "albums", album)
+        except BaseException:
+            cursor.execute("rollback to savepoint album")
+            raise
+        finally:
+            cursor.execute("release savepoint album")
 
         logging.info("Processed %s", url)
 
     return
 
-def ingest_standalones(cursor: sqlite3.Cursor, client: Client, imgur_client: ImgurClient, medias: List[Tuple[int, str]]) -> None:  # noqa: E501
-    for media_id, url in medias:
-        hash_ = get_id(url)
-        if hash_ is None:
-            logging.warning("Unable to get hash from %s, skipping", url)
-            continue
-
-        metadata = {"id": hash_, "media_id": media_id, "album_id": None}
-        if is_imgur(url):
-            api_url = make_imgur_url("image", hash_)
-            img = imgur_client.get_json(api_url)
-            if img is None:
-                logging.warning("Failed to get image metadata for %s", url)
-            else:
-                metadata.update(**img["data"])
+def fetch_standalone(client: Client, imgur_client: ImgurClient, media: Tuple[int, str]) -> Optional[Image]:  # noqa: E501
+    media_id, url = media
+    hash_ = get_id(url)
+    if hash_ is None:
+        logging.warning("Unable to get hash from %s, skipping", url)
+        return None
 
-            image = imgur_client.get_image(url, **metadata)
+    metadata = {"id": hash_, "media_id": media_id, "album_id": None}
+    if is_imgur(url):
+        api_url = make_imgur_url("image", hash_)
+        img = imgur_client.get_json(api_url)
+        if img is None:
+            logging.warning("Failed to get image metadata for %s", url)
         else:
-            # Reddit.
-            image = client.get_image(url, **metadata)
+            metadata.update(**img["data"])
 
-        insert_or_ignore(cursor, "images", image)
-        logging.info("Processed %s", url)
+        return imgur_client.get_image(url, **metadata)
+
+    # Reddit.
+    return client.get_image(url, **metadata)
+
+def ingest_standalones(cursor: sqlite3.Cursor, client: Client, imgur_client: ImgurClient, medias: List[Tuple[int, str]], concurrency: int = 1, store: Optional[BlobStore] = None) -> None:  # noqa: E501
+    # Images are downloaded by up to `concurrency` threads at once, and
+    # written from this one.
+    fetch = partial(fetch_standalone, client, imgur_client)
+    with BulkWriter(cursor, "images", batch_size=IMAGE_BATCH_SIZE) as writer:
+        for image in concurrent_map(fetch, medias, concurrency):
+            if image is None:
+                continue
+
+            writer.add(store_image(store, image))
+            logging.info("Processed %s", image.url)
 
     return
 
 def main() -> int:
     setup_logging()
-    parser = base_parser(description=__doc__)
+    parser = add_arguments(base_parser(description=__doc__))
     parser.add_argument("-t", "--client-id", type=str, help="Imgur Client ID.")
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=1,
+        help="Number of standalone images to download at once.",
+    )
+    parser.add_argument(
+        "--album-concurrency",
+        type=int,
+        default=1,
+        help="Number of images to download at once, per album.",
+    )
+    parser.add_argument(
+        "--max-album-mb",
+        type=int,
+        default=MAX_ALBUM_BYTES // (1024 * 1024),
+        help="Maximum size of album images to hold in memory at once, in MB.",
+    )
+    parser.add_argument(
+        "--blob-root",
+        type=str,
+        default=None,
+        help="Store image content in a blob store here, instead of the database.",
+    )
     args = parser.parse_args()
 
     conn = sqlite3.connect(args.conn)
     cursor = conn.cursor()
     logging.info("Established database connection")
+    migrate(cursor)
+
+    # Workers are let through as fast as each host allows, up to the
+    # given concurrency.
+    limits = HostLimits(maximum=max(args.concurrency, args.album_concurrency))
 
     status = 0
     try:
@@ -257,14 +514,33 @@ def main() -> int:
             else:
                 standalone_medias.append(media)
 
-        generic_client = Client()
-        imgur_client = ImgurClient(args.client_id)
+        session = make_session(
+            timeout=args.timeout,
+            retries=args.retries,
+            pool_size=max(args.concurrency, args.album_concurrency, DEFAULT_POOL_SIZE),
+        )
+        generic_client = Client(session, limits)
+        imgur_client = ImgurClient(
+            args.client_id,
+            session,
+            args.album_concurrency,
+            limits=limits,
+        )
+        store = BlobStore(args.blob_root) if args.blob_root is not None else None
 
         logging.info("Ingesting album media")
-        ingest_albums(cursor, imgur_client, album_medias)
+        max_album_bytes = args.max_album_mb * 1024 * 1024
+        ingest_albums(cursor, imgur_client, album_medias, max_album_bytes, store)
         logging.info("Ingesting standalone media")
-        ingest_standalones(cursor, generic_client, imgur_client, standalone_medias)
-    except (RateLimitError, requests.Timeout) as e:
+        ingest_standalones(
+            cursor,
+            generic_client,
+            imgur_client,
+            standalone_medias,
+            args.concurrency,
+            store,
+        )
+    except TRANSIENT_ERRORS as e:
         logging.error("Transient HTTP error, saving progress: %s", e)
         conn.commit()
         status = 1
@@ -277,6 +553,7 @@ def main() -> int:
     finally:
         conn.close()
         logging.info("Finished ingesting images")
+        logging.info("Concurrency limits by host: %s", limits.metrics())
 
     return status
 
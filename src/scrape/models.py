@@ -111,6 +111,8 @@ class Image:
     url: str = field(init=False)
     views: Optional[int]
     img: Optional[bytes]
+    # Set instead of `img` when content is kept in a blob store.
+    img_digest: Optional[str] = None
 
     def __post_init__(self, datetime: int, type: str, link: str, **_):
         self.uploaded_utc = datetime
@@ -145,6 +147,8 @@ class Product:
     defaultProductUrl: InitVar[str]
     default_url: str = field(init=False)
     description: Optional[str]
+    # Compressed HTML the description is derived from.
+    description_html: Optional[bytes] = None
 
     def __post_init__(self, brandName: str, productName: str, defaultProductUrl: str, **_):  # noqa: E501
         self.brand = brandName
@@ -0,0 +1,174 @@
+"""Pace requests to rate-limited APIs.
+
+Each API credential has a token bucket, shared by every client and
+thread using it, which lets requests through at a steady rate. The rate
+is narrowed by the rate-limit headers of the API's responses, so that
+the remaining requests are spread evenly until the limit resets,
+rather than spent in a burst and followed by a long wait.
+"""
+
+from time import monotonic, sleep, time
+from typing import Callable, Dict, List, Mapping, Optional, Tuple
+import threading
+
+
+# Requests remaining, and seconds until the limit resets.
+Limit = Tuple[float, float]
+LimitParser = Callable[[Mapping[str, str]], Optional[Limit]]
+
+_limiters: Dict[Tuple[str, str], "RateLimiter"] = {}
+_limiters_lock = threading.Lock()
+
+
+class TokenBucket(object):
+    """Let through `rate` requests per second, in bursts of up to `capacity`."""
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        if rate <= 0 or capacity < 1:
+            raise ValueError("`rate` must be positive and `capacity` at least 1")
+
+        self.base_rate = rate
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = monotonic()
+        # When a rate given by `update` stops applying.
+        self.until: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def _add(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _refill(self, now: float) -> None:
+        if self.until is not None and now >= self.until:
+            self._add(self.until)
+            self.rate = self.base_rate
+            self.until = None
+        self._add(now)
+
+    def _wait_time(self, now: float) -> float:
+        # Time until the bucket's deficit, if any, is paid back.
+        if self.tokens >= 0:
+            return 0
+        deficit = -self.tokens
+        if self.until is None:
+            return deficit / self.rate
+
+        window_tokens = (self.until - now) * self.rate
+        if window_tokens >= deficit:
+            return deficit / self.rate
+        return (self.until - now) + (deficit - window_tokens) / self.base_rate
+
+    def acquire(self, tokens: float = 1, timeout: Optional[float] = None) -> bool:
+        """Take tokens, waiting until they are available.
+
+        Tokens are taken before waiting, so callers are let through in
+        the order they arrive. Returns False, without taking anything,
+        if the wait would be longer than `timeout` seconds.
+        """
+        with self._lock:
+            now = monotonic()
+            self._refill(now)
+            self.tokens -= tokens
+            wait_seconds = self._wait_time(now)
+            if timeout is not None and wait_seconds > timeout:
+                self.tokens += tokens
+                return False
+
+        if wait_seconds > 0:
+            sleep(wait_seconds)
+        return True
+
+    def update(self, remaining: float, reset_seconds: float) -> None:
+        """Spread `remaining` requests over the next `reset_seconds`."""
+        if reset_seconds <= 0:
+            return
+
+        with self._lock:
+            now = monotonic()
+            self._refill(now)
+            self.rate = min(self.base_rate, max(remaining, 0) / reset_seconds)
+            self.until = now + reset_seconds
+            self.tokens = min(self.tokens, remaining)
+
+class RateLimiter(object):
+    """A token bucket, kept up to date by an API's rate-limit headers."""
+
+    def __init__(self, bucket: TokenBucket, parse_limit: LimitParser) -> None:
+        self.bucket = bucket
+        self.parse_limit = parse_limit
+
+    def acquire(self, timeout: Optional[float] = None) -> bool:
+        return self.bucket.acquire(timeout=timeout)
+
+    def update(self, headers: Mapping[str, str]) -> None:
+        limit = self.parse_limit(headers)
+        if limit is not None:
+            self.bucket.update(*limit)
+
+def most_constraining(limits: List[Limit]) -> Optional[Limit]:
+    # Limits which have already reset say nothing about the future.
+    upcoming = [limit for limit in limits if limit[1] > 0]
+    if not upcoming:
+        return None
+    return min(upcoming, key=lambda limit: limit[0] / limit[1])
+
+def reddit_limit(headers: Mapping[str, str]) -> Optional[Limit]:
+    # The reset is given in seconds from now.
+    remaining = headers.get("X-Ratelimit-Remaining")
+    reset = headers.get("X-Ratelimit-Reset")
+    if remaining is None or reset is None:
+        return None
+    return most_constraining([(float(remaining), float(reset))])
+
+def imgur_limit(headers: Mapping[str, str]) -> Optional[Limit]:
+    # User credits reset at the given epoch seconds, and client credits
+    # reset daily.
+    limits = []
+    now = time()
+    user_remaining = headers.get("X-RateLimit-UserRemaining")
+    user_reset = headers.get("X-RateLimit-UserReset")
+    if user_remaining is not None and user_reset is not None:
+        limits.append((float(user_remaining), float(user_reset) - now))
+
+    client_remaining = headers.get("X-RateLimit-ClientRemaining")
+    if client_remaining is not None:
+        limits.append((float(client_remaining), 24 * 60 * 60))
+
+    return most_constraining(limits)
+
+def zappos_limit(headers: Mapping[str, str]) -> Optional[Limit]:
+    # Short and long term limits, which reset at the given epoch
+    # milliseconds.
+    limits = []
+    now = time()
+    for type_ in ("Short", "Long"):
+        remaining = headers.get(f"X-RateLimit-{type_}-RateRemaining")
+        reset_ms = headers.get(f"X-RateLimit-{type_}-RateReset")
+        if remaining is None or reset_ms is None:
+            continue
+        limits.append((float(remaining), int(reset_ms) / 1_000 - now))
+
+    return most_constraining(limits)
+
+# Starting rate (requests per second), burst capacity, and the parser
+# for the rate-limit headers, by API.
+API_LIMITS: Dict[str, Tuple[float, float, LimitParser]] = {
+    "reddit": (1, 5, reddit_limit),
+    "imgur": (500 / (60 * 60), 50, imgur_limit),
+    "zappos": (2, 5, zappos_limit),
+}
+
+def shared_limiter(api: str, credential: str = "") -> RateLimiter:
+    """Get the limiter for an API credential, shared across clients."""
+    key = (api, credential)
+    with _limiters_lock:
+        if key not in _limiters:
+            rate, capacity, parse_limit = API_LIMITS[api]
+            _limiters[key] = RateLimiter(TokenBucket(rate, capacity), parse_limit)
+        return _limiters[key]
+
+def clear_limiters() -> None:
+    with _limiters_lock:
+        _limiters.clear()
@@ -1,23 +1,42 @@
 """Get Reddit submissions that match the search criteria."""
 
-from typing import Any, Dict, Iterator, List, Tuple, Optional
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from functools import partial
+from typing import Any, Dict, Iterator, List, Set, Tuple, Optional
 import logging
 import requests
 import sqlite3
 import sys
 
 from src.scrape.common import (
+    BulkWriter,
     base_parser,
+    concurrent_map,
     from_json,
-    insert_or_ignore,
     is_media_url,
     setup_logging,
 )
+from src.scrape.extract_links import extract_all, mark_processed
 from src.scrape.models import Media, Submission
+from src.scrape.ratelimit import RateLimiter, shared_limiter
+from src.scrape.transport import (
+    DEFAULT_POOL_SIZE,
+    add_arguments,
+    default_session,
+    make_session,
+)
+from src.utils import migrate
 
 
 MAX_LIMIT = 100
-TIMEOUT = 60
+# Reddit search gives at most this many results for a query.
+SEARCH_RESULT_CAP = 1_000
+# SQLite before 3.32 allows at most this many parameters in a statement.
+MAX_SQL_PARAMS = 999
+# Start of the history to backfill, and the width of its windows.
+HISTORY_START = datetime(2012, 1, 1, tzinfo=timezone.utc)
+WINDOW_DAYS = 30
 SUBREDDIT = "goodyearwelt"
 USER_AGENT = (
     "N/A:"                                                # Platform.
@@ -27,7 +46,7 @@ USER_AGENT = (
 )
 
 
-def search(subreddit: str, query: str, after: Optional[str] = None) -> requests.Response:
+def search(subreddit: str, query: str, after: Optional[str] = None, session: Optional[requests.Session] = None, limiter: Optional[RateLimiter] = None, syntax: Optional[str] = None) -> requests.Response:  # noqa: E501
     url = f"https://reddit.com/r/{subreddit}/search.json"
     headers = {"User-Agent": USER_AGENT}
 
@@ -40,19 +59,19 @@ def search(subreddit: str, query: str, after: Optional[str] = None) -> requests.
     }
     if after is not None:
         params.update({"after": after})
+    if syntax is not None:
+        params.update({"syntax": syntax})
 
-    response = requests.request(
-        "GET",
-        url,
-        params=params,
-        headers=headers,
-        timeout=TIMEOUT
-    )
+    session = session or default_session()
+    limiter = limiter or shared_limiter("reddit")
+    limiter.acquire()
+    response = session.request("GET", url, params=params, headers=headers)
+    limiter.update(response.headers)
     return response
 
-def paginated_search(subreddit: str, query: str, after: Optional[str]) -> Iterator[requests.Response]:  # noqa: E501
+def paginated_search(subreddit: str, query: str, after: Optional[str], session: Optional[requests.Session] = None) -> Iterator[requests.Response]:  # noqa: E501
     while True:
-        response = search(subreddit, query, after=after)
+        response = search(subreddit, query, after=after, session=session)
         if not response.ok:
             logging.error(
                 "Request failed with status %s and reason %s",
@@ -87,32 +106,376 @@ def extract_submissions(listing: Dict[str, Any], subreddit: str, query: str) ->
 
     return modeled
 
-def ingest(cursor: sqlite3.Cursor, query: str, subreddit: str) -> None:
-    responses = paginated_search(subreddit, query, after=None)
-    for response in responses:
-        listing = response.json()
-        extracted = extract_submissions(listing, subreddit, query)
-        for submission, media in extracted:
-            insert_or_ignore(cursor, "submissions", submission)
-            if media is not None:
-                insert_or_ignore(cursor, "medias", media)
+def unprocessed_bodies(cursor: sqlite3.Cursor, submissions: List[Submission]) -> List[Tuple[str, str]]:  # noqa: E501
+    bodies = {s.id: s.selftext_html for s in submissions if s.selftext_html is not None}
+    if not bodies:
+        return []
+
+    # Look the ids up in chunks, as there may be more of them, e.g. a
+    # backfill window's worth, than a statement can have parameters.
+    ids = list(bodies)
+    for start in range(0, len(ids), MAX_SQL_PARAMS):
+        chunk = ids[start:start + MAX_SQL_PARAMS]
+        params = ", ".join(["?" for _ in chunk])
+        cursor.execute(
+            f"""
+            select submission_id
+            from links_extracted
+            where submission_id in ({params})
+            """,
+            chunk
+        )
+        for submission_id, in cursor.fetchall():
+            del bodies[submission_id]
+
+    return list(bodies.items())
+
+def write_links(cursor: sqlite3.Cursor, writer: BulkWriter, extracted: "Future[Tuple[List[str], List[Media]]]") -> None:  # noqa: E501
+    submission_ids, medias = extracted.result()
+    for media in medias:
+        writer.add(media)
+    mark_processed(cursor, submission_ids)
+    return
+
+def load_crawl_state(cursor: sqlite3.Cursor, subreddit: str, query: str) -> Tuple[Optional[str], int]:  # noqa: E501
+    # Where to resume an unfinished crawl from, and the pages done so far.
+    cursor.execute(
+        """
+        select after, pages_done
+        from crawl_state
+        where subreddit = ? and search_query = ? and not is_complete
+        """,
+        (subreddit, query)
+    )
+    row = cursor.fetchone()
+    if row is None:
+        return None, 0
+
+    after: Optional[str]
+    pages_done: int
+    after, pages_done = row
+    return after, pages_done
 
+def save_crawl_state(cursor: sqlite3.Cursor, subreddit: str, query: str, after: Optional[str], pages_done: int) -> None:  # noqa: E501
+    cursor.execute(
+        """
+        insert into crawl_state (subreddit, search_query, after, pages_done, is_complete)
+        values (?, ?, ?, ?, ?)
+        on conflict (subreddit, search_query) do update set
+            after = excluded.after,
+            pages_done = excluded.pages_done,
+            is_complete = excluded.is_complete,
+            date_updated = current_timestamp
+        """,
+        (subreddit, query, after, pages_done, after is None)
+    )
     return
 
+def newest_created(cursor: sqlite3.Cursor, subreddit: str, query: str) -> Optional[int]:  # noqa: E501
+    cursor.execute(
+        """
+        select max(created_utc)
+        from submissions
+        where subreddit = ? and search_query = ?
+        """,
+        (subreddit, query)
+    )
+    newest: Optional[int] = cursor.fetchone()[0]
+    return newest
+
+def is_caught_up(cursor: sqlite3.Cursor, submissions: List[Submission], subreddit: str, query: str, newest: Optional[int]) -> bool:  # noqa: E501
+    """Check whether a page reaches submissions already held for the search.
+
+    Search results are sorted newest first, so every page after it
+    would only have older submissions. Submissions held for other
+    searches say nothing about which of this search's are held.
+    """
+    if not submissions:
+        return False
+    if newest is not None and any(s.created_utc <= newest for s in submissions):
+        return True
+
+    params = ", ".join(["?" for _ in submissions])
+    cursor.execute(
+        f"""
+        select 1
+        from submissions
+        where subreddit = ? and search_query = ? and id in ({params})
+        limit 1
+        """,
+        [subreddit, query, *(s.id for s in submissions)]
+    )
+    return cursor.fetchone() is not None
+
+def ingest(cursor: sqlite3.Cursor, query: str, subreddit: str, extract_links: bool = False, session: Optional[requests.Session] = None, resume: bool = False, incremental: bool = False) -> None:  # noqa: E501
+    """Crawl a search, committing after each page.
+
+    If `resume` is true, an unfinished crawl of the search continues
+    from the page after the last one committed. If `incremental` is
+    true, the crawl stops at the first page which reaches submissions
+    that are already held, so only new submissions are fetched. An
+    incremental crawl leaves the state of an unfinished crawl alone, so
+    that it can still be resumed.
+    """
+    if resume and incremental:
+        raise ValueError("`resume` and `incremental` may not both be given")
+
+    after, pages_done = None, 0
+    save_state = True
+    if resume:
+        after, pages_done = load_crawl_state(cursor, subreddit, query)
+        if after is not None:
+            logging.info("Resuming after %s pages", pages_done)
+    elif incremental:
+        unfinished, _ = load_crawl_state(cursor, subreddit, query)
+        if unfinished is not None:
+            logging.info("Keeping the state of an unfinished crawl, to resume later")
+            save_state = False
+
+    newest = newest_created(cursor, subreddit, query) if incremental else None
+
+    responses = paginated_search(subreddit, query, after=after, session=session)
+    submission_writer = BulkWriter(cursor, "submissions")
+    media_writer = BulkWriter(cursor, "medias")
+    # If links are extracted from submission bodies, it is done on a
+    # separate thread, overlapping with requests for the following pages.
+    pending: List[Future] = []
+    executor = ThreadPoolExecutor(max_workers=1)
+    with executor, submission_writer, media_writer:
+        for response in responses:
+            listing = response.json()
+            extracted = extract_submissions(listing, subreddit, query)
+            submissions = [s for s, _ in extracted]
+            caught_up = incremental and is_caught_up(
+                cursor,
+                submissions,
+                subreddit,
+                query,
+                newest,
+            )
+            for submission, media in extracted:
+                submission_writer.add(submission)
+                if media is not None:
+                    media_writer.add(media)
+
+            if extract_links:
+                records = unprocessed_bodies(cursor, submissions)
+                pending.append(executor.submit(extract_all, records))
+
+            while pending and pending[0].done():
+                write_links(cursor, media_writer, pending.pop(0))
+
+            # Links still being extracted are committed with a later page.
+            submission_writer.flush()
+            media_writer.flush()
+            pages_done += 1
+            after = None if caught_up else listing["data"]["after"]
+            if save_state:
+                save_crawl_state(cursor, subreddit, query, after, pages_done)
+            cursor.connection.commit()
+            if caught_up:
+                logging.info("Caught up after %s pages", pages_done)
+                break
+
+        for future in pending:
+            write_links(cursor, media_writer, future)
+
+    cursor.connection.commit()
+    return
+
+def time_windows(start: int, stop: int, width: int) -> List[Tuple[int, int]]:
+    # Inclusive ranges of epoch seconds, covering `start` to `stop`.
+    return [
+        (lower, min(lower + width - 1, stop))
+        for lower in range(start, stop + 1, width)
+    ]
+
+def window_query(query: str, window: Tuple[int, int]) -> str:
+    # Cloudsearch syntax, which supports searching by timestamp.
+    lower, upper = window
+    timestamp = f"timestamp:{lower}..{upper}"
+    if not query:
+        return timestamp
+    escaped = query.replace("\\", "\\\\").replace("'", "\\'")
+    return f"(and {timestamp} '{escaped}')"
+
+def crawl_window(subreddit: str, query: str, session: Optional[requests.Session], window: Tuple[int, int]) -> Tuple[str, int, List[Tuple[Submission, Optional[Media]]]]:  # noqa: E501
+    # Unlike `paginated_search`, a failed page fails the whole window,
+    # so that it is crawled again.
+    q = window_query(query, window)
+    after: Optional[str] = None
+    pages_done = 0
+    extracted = []
+    while True:
+        response = search(
+            subreddit,
+            q,
+            after=after,
+            session=session,
+            syntax="cloudsearch",
+        )
+        response.raise_for_status()
+        listing = response.json()
+        extracted.extend(extract_submissions(listing, subreddit, query))
+        pages_done += 1
+
+        after = listing["data"]["after"]
+        if after is None:
+            break
+
+    return q, pages_done, extracted
+
+def completed_crawls(cursor: sqlite3.Cursor, subreddit: str) -> Set[str]:
+    cursor.execute(
+        "select search_query from crawl_state where subreddit = ? and is_complete",
+        (subreddit,)
+    )
+    return {search_query for search_query, in cursor.fetchall()}
+
+def backfill(cursor: sqlite3.Cursor, query: str, subreddit: str, windows: List[Tuple[int, int]], workers: int = 1, extract_links: bool = False, session: Optional[requests.Session] = None) -> int:  # noqa: E501
+    """Crawl a search's history, a window of time at a time.
+
+    Windows are crawled by up to `workers` threads at once, sharing the
+    Reddit rate limit, and written from this one. Each window's crawl
+    is recorded once written, so windows which have already been
+    crawled are skipped.
+    """
+    done = completed_crawls(cursor, subreddit)
+    pending = [window for window in windows if window_query(query, window) not in done]
+    logging.info("Crawling %s of %s windows", len(pending), len(windows))
+
+    crawl = partial(crawl_window, subreddit, query, session)
+    n_written = 0
+    submission_writer = BulkWriter(cursor, "submissions")
+    media_writer = BulkWriter(cursor, "medias")
+    with submission_writer, media_writer:
+        for q, pages_done, extracted in concurrent_map(crawl, pending, workers):
+            if len(extracted) >= SEARCH_RESULT_CAP:
+                logging.warning("Window %s may be truncated, use narrower windows", q)
+
+            for submission, media in extracted:
+                submission_writer.add(submission)
+                if media is not None:
+                    media_writer.add(media)
+
+            if extract_links:
+                records = unprocessed_bodies(cursor, [s for s, _ in extracted])
+                submission_ids, medias = extract_all(records)
+                for media in medias:
+                    media_writer.add(media)
+                mark_processed(cursor, submission_ids)
+
+            submission_writer.flush()
+            media_writer.flush()
+            save_crawl_state(cursor, subreddit, q, None, pages_done)
+            cursor.connection.commit()
+            n_written += len(extracted)
+            logging.info("Crawled %s, %s submissions so far", q, n_written)
+
+    return n_written
+
+def parse_date(string: str) -> datetime:
+    return datetime.strptime(string, "%Y-%m-%d").replace(tzinfo=timezone.utc)
+
 def main() -> int:
     setup_logging()
-    parser = base_parser(description=__doc__)
+    parser = add_arguments(base_parser(description=__doc__))
     parser.add_argument("-q", "--query", type=str, help="Query string.")
+    parser.add_argument(
+        "--extract-links",
+        action="store_true",
+        help="Also extract links from submission bodies.",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Resume an interrupted crawl of the query.",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only fetch submissions newer than those already held.",
+    )
+    parser.add_argument(
+        "--backfill",
+        action="store_true",
+        help="Crawl the query's history in windows of time, concurrently.",
+    )
+    parser.add_argument(
+        "--since",
+        type=parse_date,
+        default=HISTORY_START,
+        help="Start of the history to backfill, as YYYY-MM-DD.",
+    )
+    parser.add_argument(
+        "--until",
+        type=parse_date,
+        default=None,
+        help="End of the history to backfill, as YYYY-MM-DD. Defaults to now.",
+    )
+    parser.add_argument(
+        "--window-days",
+        type=int,
+        default=WINDOW_DAYS,
+        help="Width of the windows to backfill, in days.",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of windows to backfill at once.",
+    )
     args = parser.parse_args()
 
+    if sum([args.resume, args.incremental, args.backfill]) > 1:
+        raise RuntimeError(
+            "Only one of `resume`, `incremental` and `backfill` may be given"
+        )
+
     conn = sqlite3.connect(args.conn)
     cursor = conn.cursor()
     logging.info("Established database connection")
+    migrate(cursor)
 
     status = 0
     try:
         logging.info("Starting ingest for %s", args.query)
-        ingest(cursor, args.query, SUBREDDIT)
+        session = make_session(
+            timeout=args.timeout,
+            retries=args.retries,
+            pool_size=max(args.workers, DEFAULT_POOL_SIZE),
+        )
+        if args.backfill:
+            until = args.until or datetime.now(timezone.utc)
+            windows = time_windows(
+                int(args.since.timestamp()),
+                int(until.timestamp()),
+                int(timedelta(days=args.window_days).total_seconds()),
+            )
+            backfill(
+                cursor,
+                args.query,
+                SUBREDDIT,
+                windows,
+                args.workers,
+                args.extract_links,
+                session,
+            )
+        else:
+            ingest(
+                cursor,
+                args.query,
+                SUBREDDIT,
+                args.extract_links,
+                session,
+                args.resume,
+                args.incremental,
+            )
+    except requests.RequestException as e:
+        logging.error("HTTP error, saving progress: %s", e)
+        conn.commit()
+        status = 1
     except sqlite3.Error as e:
         logging.error("Encountered error, aborting: %s", e)
         conn.rollback()
@@ -0,0 +1,88 @@
+"""Shared HTTP sessions.
+
+Clients make requests through a `Session`, which keeps connections
+alive between requests, so that repeated requests to the same host do
+not each pay for a new connection (and TLS handshake). Connections are
+pooled per host, and failed connections or reads are retried with
+back-off. HTTP error statuses are not retried here, as clients handle
+those themselves (e.g. rate limiting).
+"""
+
+from typing import Mapping, Optional
+import argparse
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+DEFAULT_TIMEOUT = 60
+DEFAULT_RETRIES = 2
+DEFAULT_BACKOFF = 0.5
+# Maximum number of connections kept alive per host.
+DEFAULT_POOL_SIZE = 10
+
+_default_session: Optional["Session"] = None
+
+
+class Session(requests.Session):
+    """A `requests.Session` with a default timeout."""
+
+    def __init__(self, timeout: float = DEFAULT_TIMEOUT) -> None:
+        super().__init__()
+        self.timeout = timeout
+
+    def request(self, method, url, **kwds) -> requests.Response:  # type: ignore
+        kwds.setdefault("timeout", self.timeout)
+        return super().request(method, url, **kwds)
+
+def make_adapter(pool_size: int, retries: int, backoff: float) -> HTTPAdapter:
+    max_retries = Retry(
+        total=retries,
+        connect=retries,
+        read=retries,
+        status=0,
+        backoff_factor=backoff,
+        raise_on_status=False,
+    )
+    return HTTPAdapter(pool_maxsize=pool_size, max_retries=max_retries)
+
+def make_session(
+    timeout: float = DEFAULT_TIMEOUT,
+    retries: int = DEFAULT_RETRIES,
+    backoff: float = DEFAULT_BACKOFF,
+    pool_size: int = DEFAULT_POOL_SIZE,
+    host_pool_sizes: Optional[Mapping[str, int]] = None,
+) -> Session:
+    """Make a session.
+
+    `host_pool_sizes` maps URL prefixes, e.g. "https://i.imgur.com",
+    to the number of connections to keep alive for them, overriding
+    `pool_size`.
+    """
+    session = Session(timeout)
+    for prefix in ("http://", "https://"):
+        session.mount(prefix, make_adapter(pool_size, retries, backoff))
+    for prefix, size in (host_pool_sizes or {}).items():
+        session.mount(prefix, make_adapter(size, retries, backoff))
+    return session
+
+def default_session() -> Session:
+    global _default_session
+    if _default_session is None:
+        _default_session = make_session()
+    return _default_session
+
+def add_arguments(parser: argparse.ArgumentParser) -> argparse.ArgumentParser:
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=DEFAULT_TIMEOUT,
+        help="HTTP request timeout, in seconds.",
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=DEFAULT_RETRIES,
+        help="Number of times to retry failed HTTP connections.",
+    )
+    return parser
@@ -1,18 +1,49 @@
 """Collect training data from Zappos."""
 
 from bs4 import BeautifulSoup, element
-from datetime import datetime
-from time import sleep
-from typing import Dict, Iterable, List, MutableMapping, Optional
+from collections import deque
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+from functools import lru_cache, partial
+from time import sleep, time
+from typing import (
+    Callable,
+    Deque,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Pattern,
+    Set,
+    Tuple,
+)
 import json
 import logging
+import math
+import multiprocessing
 import re
 import requests
 import sqlite3
 import sys
-
-from src.scrape.common import base_parser, insert_or_ignore, from_json, setup_logging
+import zlib
+
+from src.scrape.adaptive import AdaptiveLimit
+from src.scrape.common import (
+    BulkWriter,
+    base_parser,
+    concurrent_map,
+    from_json,
+    setup_logging,
+)
 from src.scrape.models import Product, ProductSearchResult
+from src.scrape.ratelimit import RateLimiter, shared_limiter
+from src.scrape.transport import (
+    DEFAULT_POOL_SIZE,
+    add_arguments,
+    default_session,
+    make_session,
+)
+from src.utils import migrate
 
 
 # If a larger limit is requested, the server will impose this limit.
@@ -22,29 +53,17 @@ MAX_SEARCH_LIMIT = 500
 # smaller set in the interest of reducing the number of requests.
 SHOE_CATEGORIES = ("Shoes", "Boots")
 LOG_INTERVAL = 50
+# Number of products to write between commits.
+COMMIT_INTERVAL = 500
 # Ignore these HTTP status codes when attempting to fetch products.
 SKIP_PRODUCT_STATUSES = (404, 504)
+# Products which fail with these are never requested again. Others are
+# retried, waiting twice as long after each failed attempt.
+PERMANENT_PRODUCT_STATUSES = (404,)
+RETRY_BASE_SECONDS = 60 * 60
+RETRY_MAX_SECONDS = 30 * 24 * 60 * 60
 
 
-def reset_time(headers: MutableMapping[str, str]) -> float:
-    def le_threshold(type_: str) -> bool:
-        remaining = headers.get(f"X-RateLimit-{type_}-RateRemaining")
-        if remaining is None:
-            return False
-        return int(remaining) <= 1
-
-    reset_long = le_threshold("Long")
-    reset_short = le_threshold("Short")
-
-    if not reset_long and not reset_short:
-        return 0
-
-    type_ = "Long" if reset_long else "Short"
-    reset_ms = int(headers.get(f"X-RateLimit-{type_}-RateReset", 0))
-    reset_time = datetime.fromtimestamp(reset_ms / 1_000)
-    wait_seconds = (reset_time - datetime.now()).total_seconds()
-    return wait_seconds
-
 def strip_legal_signs(string: str) -> str:
     signs = (
         "\N{REGISTERED SIGN}",
@@ -55,8 +74,12 @@ def strip_legal_signs(string: str) -> str:
         string = string.replace(sign, "")
     return string
 
+@lru_cache(maxsize=1_024)
+def brand_pattern(brand: str) -> Pattern[str]:
+    return re.compile(rf"\b{brand}\b", flags=re.IGNORECASE)
+
 def extract_description(description_html: str, brand: str) -> Optional[str]:
-    pattern = re.compile(rf"\b{brand}\b", flags=re.IGNORECASE)
+    pattern = brand_pattern(brand)
     soup = BeautifulSoup(description_html, "html.parser")
 
     for item in soup.find_all("li"):
@@ -78,13 +101,28 @@ def extract_description(description_html: str, brand: str) -> Optional[str]:
 
     return None
 
+def compress_description(description_html: str) -> bytes:
+    return zlib.compress(description_html.encode())
+
+def derive_description(description_html: bytes, brand: str) -> Optional[str]:
+    # Runs in worker processes, so takes the compressed HTML, which is
+    # cheaper to send.
+    return extract_description(zlib.decompress(description_html).decode(), brand)
+
 class ZapposClient(object):
     base_url = "http://api.zappos.com"
-    max_retries = 1
-    retry_delay_seconds = 2 * 60
+    max_retries = 3
+    # How long to back off for after being throttled, doubling with each
+    # attempt. The wait for the rate limit itself is left to the limiter.
+    backoff_seconds = 1
+    max_backoff_seconds = 8
 
-    def __init__(self, api_key: str):
+    def __init__(self, api_key: str, session: Optional[requests.Session] = None, limiter: Optional[RateLimiter] = None, concurrency: Optional[AdaptiveLimit] = None):  # noqa: E501
         self.api_key = api_key
+        self.session = session or default_session()
+        self.limiter = limiter or shared_limiter("zappos", api_key)
+        # Number of requests to make at once.
+        self.concurrency = concurrency or AdaptiveLimit()
 
     def with_key(self, params: Dict[str, str]) -> Dict[str, str]:
         return {**params, "key": self.api_key}
@@ -92,24 +130,26 @@ class ZapposClient(object):
     def dispatch(self, method: str, url: str, **kwds) -> requests.Response:
         params = self.with_key(kwds.pop("params", {}))
 
-        for _ in range(self.max_retries + 1):
-            response = requests.request(method, url, params=params, **kwds)
-            if response.status_code != 429:
+        for attempt in range(self.max_retries + 1):
+            # Requests are paced to stay under the rate limit, rather than
+            # waiting for it to reset once it is nearly reached.
+            self.limiter.acquire()
+            request = partial(self.session.request, method, url, params=params, **kwds)
+            response = self.concurrency.call(request)
+            self.limiter.update(response.headers)
+            if response.status_code != 429 or attempt == self.max_retries:
                 break
 
-            logging.warning(
-                "Encountered rate limit, waiting %s seconds",
-                self.retry_delay_seconds
+            # The limiter and concurrency limit have both been cut back by
+            # the response, so only back off briefly before retrying.
+            delay_seconds = min(
+                self.max_backoff_seconds,
+                self.backoff_seconds * 2 ** attempt,
             )
-            sleep(self.retry_delay_seconds)
+            logging.warning("Encountered rate limit, waiting %s seconds", delay_seconds)
+            sleep(delay_seconds)
 
         response.raise_for_status()
-
-        # Pre-empt rate-limiting.
-        wait_time = reset_time(response.headers)
-        if wait_time > 0:
-            logging.info("Approaching rate limit - waiting %s seconds", wait_time)
-            sleep(wait_time)
         return response
 
     def search(self, term: str, page: int, limit: int) -> requests.Response:
@@ -123,7 +163,12 @@ class ZapposClient(object):
         }
         return self.dispatch("GET", search_url, params=params)
 
-    def product_description(self, product_id: int) -> Product:
+    def product_description(self, product_id: int, parse: bool = True) -> Product:
+        """Get a product.
+
+        The product's description HTML is kept, compressed, and if `parse`
+        is true, its description is extracted from it.
+        """
         if product_id < 0:
             raise ValueError("`product_id` cannot be negative")
 
@@ -143,108 +188,413 @@ class ZapposClient(object):
             )
 
         product = from_json(Product, **product_raw, id=product_id)
-        if product.description is not None:
-            sentence = extract_description(product.description, product.brand)
-            product.description = sentence
+        description_html = product.description
+        product.description = None
+        if description_html is not None:
+            product.description_html = compress_description(description_html)
+            if parse:
+                product.description = extract_description(description_html, product.brand)
         return product
 
-def paginated_search(client: ZapposClient, term: str) -> List[ProductSearchResult]:
-    stop_at = None
-    page = 1
-    results: List[ProductSearchResult] = []
-    while stop_at is None or len(results) < stop_at:
-        response = client.search(term, page=page, limit=MAX_SEARCH_LIMIT)
+def search_page(client: ZapposClient, term: str, page: int) -> Tuple[int, List[ProductSearchResult]]:  # noqa: E501
+    # Get a page of results, and the total number of results.
+    response = client.search(term, page=page, limit=MAX_SEARCH_LIMIT)
+    data = response.json()
+    results = [
+        from_json(ProductSearchResult, **result, search_query=term)
+        for result in data["results"]
+    ]
+    return int(data["totalResultCount"]), results
+
+def iter_search_pages(client: ZapposClient, term: str, workers: int = 1) -> Iterator[List[ProductSearchResult]]:  # noqa: E501
+    """Get search results a page at a time.
+
+    The first page gives the number of pages, after which the rest are
+    fetched on up to `workers` threads at once, and yielded in the order
+    they complete.
+    """
+    total, results = search_page(client, term, 1)
+    yield results
+    if not results:
+        return
+
+    # The server may return fewer results per page than were asked for.
+    n_pages = math.ceil(total / len(results))
+
+    def fetch(page: int) -> List[ProductSearchResult]:
+        _, results = search_page(client, term, page)
+        return results
+
+    yield from concurrent_map(fetch, range(2, n_pages + 1), workers)
+    return
+
+def paginated_search(client: ZapposClient, term: str, workers: int = 1) -> List[ProductSearchResult]:  # noqa: E501
+    return [
+        result
+        for results in iter_search_pages(client, term, workers)
+        for result in results
+    ]
+
+def read_terms(path: str) -> List[str]:
+    # One term per line, ignoring blank lines and comments.
+    with open(path) as fh:
+        lines = [line.strip() for line in fh]
+    terms = [line for line in lines if line and not line.startswith("#")]
+    return list(dict.fromkeys(terms))
+
+def completed_searches(cursor: sqlite3.Cursor) -> Set[str]:
+    cursor.execute("select search_query from completed_searches")
+    return {search_query for search_query, in cursor.fetchall()}
+
+def mark_completed(cursor: sqlite3.Cursor, term: str) -> None:
+    cursor.execute(
+        "insert or ignore into completed_searches (search_query) values (?)",
+        (term,)
+    )
+    return
+
+def ingest_search(cursor: sqlite3.Cursor, client: ZapposClient, term: str, workers: int = 1) -> int:  # noqa: E501
+    # Pages are written, and committed, as they arrive, rather than held
+    # until the search is done. Results which were already written, e.g.
+    # by an earlier, interrupted, search, are ignored.
+    with BulkWriter(cursor, "searches") as writer:
+        for results in iter_search_pages(client, term, workers):
+            for result in results:
+                writer.add(result)
+            writer.flush()
+            cursor.connection.commit()
+
+    mark_completed(cursor, term)
+    cursor.connection.commit()
+    return writer.count
+
+def search_term(client: ZapposClient, term: str) -> Tuple[str, List[ProductSearchResult]]:  # noqa: E501
+    return term, paginated_search(client, term)
+
+def run_campaign(cursor: sqlite3.Cursor, client: ZapposClient, terms: List[str], workers: int = 1) -> int:  # noqa: E501
+    """Search for each of `terms`, up to `workers` at once.
+
+    Terms which have already been searched for are skipped. A product
+    found by more than one term is only written for the first. Each
+    term's results are committed as soon as the term is done, so an
+    interrupted campaign resumes with the terms that are left.
+    """
+    done = completed_searches(cursor)
+    pending = [term for term in terms if term not in done]
+    logging.info("Searching for %s of %s terms", len(pending), len(terms))
+
+    cursor.execute("select distinct product_id from searches")
+    seen = {product_id for product_id, in cursor.fetchall()}
+
+    # Terms are searched by the workers, sharing the client's rate limit,
+    # and written from this thread.
+    results = concurrent_map(partial(search_term, client), pending, workers)
+    with BulkWriter(cursor, "searches") as writer:
+        for i, (term, term_results) in enumerate(results, start=1):
+            for result in term_results:
+                if result.product_id in seen:
+                    continue
+                seen.add(result.product_id)
+                writer.add(result)
+
+            writer.flush()
+            mark_completed(cursor, term)
+            cursor.connection.commit()
+            logging.info("Searched for %s (%s/%s)", term, i, len(pending))
+
+    return writer.count
+
+def next_eligible(status: int, attempts: int, now: float) -> Optional[float]:
+    if status in PERMANENT_PRODUCT_STATUSES:
+        return None
+    wait_seconds: float = min(RETRY_BASE_SECONDS * 2 ** (attempts - 1), RETRY_MAX_SECONDS)
+    return now + wait_seconds
+
+def record_failure(cursor: sqlite3.Cursor, product_id: int, status: int) -> None:
+    cursor.execute(
+        "select attempts from product_fetches where product_id = ?",
+        (product_id,)
+    )
+    row = cursor.fetchone()
+    attempts = 1 if row is None else row[0] + 1
+    cursor.execute(
+        """
+        insert into product_fetches (product_id, status, attempts, next_eligible_utc)
+        values (?, ?, ?, ?)
+        on conflict (product_id) do update set
+            status = excluded.status,
+            attempts = excluded.attempts,
+            next_eligible_utc = excluded.next_eligible_utc,
+            date_updated = current_timestamp
+        """,
+        (product_id, status, attempts, next_eligible(status, attempts, time()))
+    )
+    return
+
+def fetch_candidates(cursor: sqlite3.Cursor, now: float) -> List[ProductSearchResult]:
+    cursor.execute(
+        """
+        select
+            brand,
+            product_id,
+            product_name,
+            category,
+            search_query
+        from (
+            select
+                *,
+                row_number() over (partition by product_id) as row_no
+            from searches
+            where
+                -- Kids brands won't be on /r/goodyearwelt.
+                lower(brand) not like '%kids%'
+                -- These will simply become confusing.
+                and lower(brand) not like '%boots'
+                and lower(brand) not like '%shoes'
+        ) as t
+        where
+            row_no = 1
+            and product_id not in (select id from products)
+            and product_id not in (
+                select product_id
+                from product_fetches
+                where next_eligible_utc is null or next_eligible_utc > ?
+            );
+        """,
+        (now,)
+    )
+    return [ProductSearchResult(*row) for row in cursor]
 
-        data = response.json()
-        if stop_at is None:
-            stop_at = int(data["totalResultCount"])
+def fetch_product(client: ZapposClient, record: ProductSearchResult, parse: bool = True) -> Tuple[ProductSearchResult, Optional[Product], Optional[int]]:  # noqa: E501
+    # Returns the product, or the status it was skipped with.
+    try:
+        return record, client.product_description(record.product_id, parse), None
+    except requests.RequestException as e:
+        if e.response is not None and e.response.status_code in SKIP_PRODUCT_STATUSES:
+            return record, None, e.response.status_code
+        raise e
+
+def get_products(client: ZapposClient, records: List[ProductSearchResult], workers: int = 1, on_skip: Optional[Callable[[int, int], None]] = None, parse: bool = True) -> Iterable[Product]:  # noqa: E501
+    """Fetch products, on up to `workers` threads at once.
+
+    With more than one worker, products are yielded in the order their
+    fetches complete. Skipped products are passed to `on_skip`, with
+    the status they failed with, from the calling thread.
+    """
+    fetch = partial(fetch_product, client, parse=parse)
+    results = concurrent_map(fetch, records, workers)
+    for i, (record, product, status) in enumerate(results, start=1):
+        if i % LOG_INTERVAL == 0:
+            logging.info(f"Fetched product {i}/{len(records)}")
 
-        results.extend([
-            from_json(ProductSearchResult, **result, search_query=term)
-            for result in data["results"]
-        ])
-        page += 1
+        if product is not None:
+            yield product
+        elif on_skip is not None and status is not None:
+            on_skip(record.product_id, status)
 
-    return results
+def parse_descriptions(executor: Executor, products: Iterable[Product], max_pending: int) -> Iterator[Product]:  # noqa: E501
+    """Derive products' descriptions on `executor`.
 
-def get_products(client: ZapposClient, records: List[ProductSearchResult]) -> Iterable[Product]:  # noqa: E501
-    for i, record in enumerate(records, start=1):
-        if i % LOG_INTERVAL == 0:
-            logging.info(f"Fetching product {i}/{len(records)}")
+    Products are yielded in the order they are given, once their
+    description has been derived, with at most `max_pending` waiting.
+    """
+    pending: Deque[Tuple[Product, Optional["Future[Optional[str]]"]]] = deque()
 
-        try:
-            product = client.product_description(record.product_id)
-        except requests.RequestException as e:
-            if e.response.status_code in SKIP_PRODUCT_STATUSES:
-                continue
-            raise e
-        yield product
+    def finish() -> Product:
+        product, future = pending.popleft()
+        if future is not None:
+            product.description = future.result()
+        return product
+
+    try:
+        for product in products:
+            future = None
+            if product.description_html is not None:
+                future = executor.submit(
+                    derive_description,
+                    product.description_html,
+                    product.brand,
+                )
+            pending.append((product, future))
+
+            while pending and (len(pending) > max_pending or is_ready(pending[0][1])):
+                yield finish()
+    except Exception:
+        # Pass on products fetched before an error, so that they can
+        # still be written.
+        while pending:
+            yield finish()
+        raise
+
+    while pending:
+        yield finish()
+
+    return
+
+def is_ready(future: Optional[Future]) -> bool:
+    return future is None or future.done()
+
+def write_products(cursor: sqlite3.Cursor, products: Iterable[Product], commit_interval: int) -> int:  # noqa: E501
+    # Commit as products are written, so that progress survives an error.
+    with BulkWriter(cursor, "products") as writer:
+        for i, product in enumerate(products, start=1):
+            writer.add(product)
+            if i % commit_interval == 0:
+                writer.flush()
+                cursor.connection.commit()
+
+    return writer.count
+
+def ingest_products(cursor: sqlite3.Cursor, client: ZapposClient, records: List[ProductSearchResult], workers: int = 1, commit_interval: int = COMMIT_INTERVAL, processes: int = 1) -> int:  # noqa: E501
+    # Products are fetched by the workers, their descriptions are parsed
+    # on a pool of `processes`, or inline given only one, and they are
+    # written from this thread. Failed fetches are recorded, so they
+    # aren't retried too soon.
+    on_skip = partial(record_failure, cursor)
+    if processes <= 1:
+        products = get_products(client, records, workers, on_skip, parse=True)
+        return write_products(cursor, products, commit_interval)
+
+    # Parsing processes are spawned, rather than forked, as they are
+    # started while the fetching threads are running and may hold locks,
+    # e.g. of the session's connection pool or of logging.
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=processes, mp_context=context) as executor:
+        products = get_products(client, records, workers, on_skip, parse=False)
+        parsed = parse_descriptions(executor, products, max_pending=4 * processes)
+        return write_products(cursor, parsed, commit_interval)
+
+def rederive_descriptions(cursor: sqlite3.Cursor, processes: int = 1, chunk_size: int = COMMIT_INTERVAL) -> int:  # noqa: E501
+    """Derive every product's description again, from its stored HTML."""
+    n_derived = 0
+    last_id = -1
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        while True:
+            cursor.execute(
+                """
+                select id, brand, description_html
+                from products
+                where description_html is not null and id > ?
+                order by id
+                limit ?
+                """,
+                (last_id, chunk_size)
+            )
+            records = cursor.fetchall()
+            if not records:
+                break
+
+            ids, brands, htmls = zip(*records)
+            chunksize = max(1, len(records) // (4 * processes))
+            descriptions = executor.map(
+                derive_description,
+                htmls,
+                brands,
+                chunksize=chunksize,
+            )
+            cursor.executemany(
+                "update products set description = ? where id = ?",
+                zip(descriptions, ids)
+            )
+            cursor.connection.commit()
+
+            last_id = ids[-1]
+            n_derived += len(records)
+            logging.info("Derived %s descriptions", n_derived)
+
+    return n_derived
 
 def main() -> int:
     setup_logging()
-    parser = base_parser(description=__doc__)
-    parser.add_argument("--api-key", required=True, type=str, help="Zappos API key.")
+    parser = add_arguments(base_parser(description=__doc__))
+    parser.add_argument("--api-key", type=str, default="", help="Zappos API key.")
     parser.add_argument("--search", action="store_true", help="Search for products.")
     parser.add_argument("--query", type=str, default="", help="Search query.")
+    parser.add_argument(
+        "--campaign",
+        type=str,
+        default=None,
+        help="Search for each term in this file, one per line, instead of `query`.",
+    )
     parser.add_argument("--fetch", action="store_true", help="Get product information.")
+    parser.add_argument(
+        "--rederive",
+        action="store_true",
+        help="Derive product descriptions again from their stored HTML, offline.",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of products, search pages or terms to fetch at once, at most.",
+    )
+    parser.add_argument(
+        "-p",
+        "--processes",
+        type=int,
+        default=1,
+        help="Number of processes to parse product descriptions with.",
+    )
     args = parser.parse_args()
 
-    if args.search and args.fetch:
-        raise RuntimeError("`search` and `fetch` may not both be given")
+    n_commands = sum([args.search, args.fetch, args.rederive])
+    if n_commands > 1:
+        raise RuntimeError("Only one of `search`, `fetch` and `rederive` may be given")
+
+    if n_commands == 0:
+        raise RuntimeError("`search`, `fetch` or `rederive` must be given")
 
-    if not args.search and not args.fetch:
-        raise RuntimeError("`search` or `fetch` must be given")
+    if not args.rederive and not args.api_key:
+        raise RuntimeError("`api-key` must be given to make requests")
 
     conn = sqlite3.connect(args.conn)
     cursor = conn.cursor()
+    migrate(cursor)
 
-    client = ZapposClient(args.api_key)
+    session = make_session(
+        timeout=args.timeout,
+        retries=args.retries,
+        pool_size=max(args.workers, DEFAULT_POOL_SIZE),
+    )
+    # Within the rate limit, workers are let through as fast as the
+    # server keeps up.
+    concurrency = AdaptiveLimit(maximum=max(args.workers, 1))
+    client = ZapposClient(args.api_key, session, concurrency=concurrency)
 
     status = 0
     try:
-        if args.search:
+        if args.search and args.campaign is not None:
+            terms = read_terms(args.campaign)
+            logging.info("Starting campaign of %s searches", len(terms))
+            n_written = run_campaign(cursor, client, terms, args.workers)
+            logging.info("Wrote %s search results", n_written)
+        elif args.search:
             logging.info("Starting product search for %s", args.query)
-            search_results = paginated_search(client, term=args.query)
-            logging.info("Writing %s search results", len(search_results))
-            for result in search_results:
-                insert_or_ignore(cursor, "searches", result)
+            n_written = ingest_search(cursor, client, args.query, args.workers)
+            logging.info("Wrote %s search results", n_written)
         elif args.fetch:
             logging.info("Getting products to fetch")
-            cursor.execute(
-                """
-                select
-                    brand,
-                    product_id,
-                    product_name,
-                    category,
-                    search_query
-                from (
-                    select
-                        *,
-                        row_number() over (partition by product_id) as row_no
-                    from searches
-                    where
-                        -- Kids brands won't be on /r/goodyearwelt.
-                        lower(brand) not like '%kids%'
-                        -- These will simply become confusing.
-                        and lower(brand) not like '%boots'
-                        and lower(brand) not like '%shoes'
-                ) as t
-                where
-                    row_no = 1
-                    and product_id not in (select id from products);
-                """
-            )
-            records = [ProductSearchResult(*row) for row in cursor]
+            records = fetch_candidates(cursor, time())
             logging.info("Found %s products", len(records))
 
             logging.info("Ingesting product(s) information")
-            for product in get_products(client, records):
-                insert_or_ignore(cursor, "products", product)
+            n_written = ingest_products(
+                cursor,
+                client,
+                records,
+                args.workers,
+                processes=args.processes,
+            )
+            logging.info("Wrote %s products", n_written)
+        elif args.rederive:
+            logging.info("Deriving product descriptions")
+            n_derived = rederive_descriptions(cursor, args.processes)
+            logging.info("Derived %s descriptions", n_derived)
     except Exception as e:
         status = 1
         logging.error("Encountered error, aborting: %s", e)
-        if not args.fetch:
+        if args.search:
             conn.rollback()
         else:
             conn.commit()
@@ -253,6 +603,7 @@ def main() -> int:
         conn.commit()
     finally:
         conn.close()
+        logging.info("Concurrency limit: %s", client.concurrency.current)
 
     return status
 
@@ -0,0 +1,12 @@
+-- Submissions whose bodies have been searched for links.
+create table links_extracted (
+    submission_id varchar primary key,
+    date_created datetime default current_timestamp,
+    foreign key (submission_id) references submissions(id)
+);
+
+-- Submissions with indirect links have certainly been processed already.
+insert into links_extracted (submission_id)
+select distinct submission_id
+from medias
+where not is_direct;
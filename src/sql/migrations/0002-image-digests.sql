@@ -0,0 +1,4 @@
+-- Image content may be kept outside of the database, in a blob store,
+-- in which case `img` is null and `img_digest` is its key in the store.
+alter table images add column img_digest varchar;
+create index images_img_digest_idx on images(img_digest);
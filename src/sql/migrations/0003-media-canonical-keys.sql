@@ -0,0 +1,4 @@
+-- Identifies the resource a media's url points to, so that medias
+-- linking to the same resource in different forms can share it.
+alter table medias add column canonical_key varchar;
+create index medias_canonical_key_idx on medias(canonical_key);
@@ -0,0 +1,10 @@
+-- Products which could not be fetched, with the status of the last
+-- attempt. A product is not requested again before `next_eligible_utc`
+-- (epoch seconds), or ever, if it is null.
+create table product_fetches (
+    product_id integer primary key,
+    status integer not null,
+    attempts integer not null,
+    next_eligible_utc real,
+    date_updated datetime default current_timestamp
+);
@@ -0,0 +1,11 @@
+-- Search queries whose results have all been written, so that a
+-- campaign of searches can resume where it left off.
+create table completed_searches (
+    search_query varchar primary key,
+    date_created datetime default current_timestamp
+);
+
+-- Searches were only ever committed once complete.
+insert into completed_searches (search_query)
+select distinct search_query
+from searches;
@@ -0,0 +1,3 @@
+-- A product's description as fetched, zlib-compressed HTML, so that
+-- `description` can be derived again without fetching the product.
+alter table products add column description_html blob;
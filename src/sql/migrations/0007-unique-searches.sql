@@ -0,0 +1,13 @@
+-- A product is recorded once per search query. Keep the earliest of
+-- any duplicates, then enforce it.
+delete from searches
+where rowid not in (
+    select min(rowid)
+    from searches
+    group by product_id, search_query
+);
+
+-- Lookups by product id are served by the new index.
+drop index product_id_idx;
+create unique index searches_product_id_search_query_idx
+on searches(product_id, search_query);
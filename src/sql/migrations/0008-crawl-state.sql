@@ -0,0 +1,13 @@
+-- Progress of the latest crawl of each search, so that an interrupted
+-- crawl can resume from the page after the last one committed.
+create table crawl_state (
+    subreddit varchar not null,
+    search_query varchar not null,
+    -- Pagination token for the next page.
+    after varchar,
+    pages_done integer not null,
+    is_complete boolean not null,
+    date_updated datetime default current_timestamp,
+
+    primary key (subreddit, search_query)
+);
@@ -31,6 +31,19 @@ inner join (
 on a.media_id = i.media_id;
 
 
+-- Images for every media, including medias whose resource was
+-- fetched through another media with the same canonical key.
+create temp view media_images as
+select
+    m.id as media_id,
+    i.id as image_id
+from medias as m
+inner join medias as fetched
+on m.canonical_key = fetched.canonical_key
+inner join images as i
+on fetched.id = i.media_id;
+
+
 -- All rolled-up medias.
 -- Assume that images that are not part of albums do not
 -- have meaningful titles or descriptions, and as such
@@ -4,6 +4,19 @@ import sqlite3
 
 _rollups_sql = get_data("src", "sql/views-rollups.sql")
 
+# Applied in order, on top of `sql/schema.sql`. The database's
+# `user_version` is the number of migrations which have been applied.
+MIGRATIONS = (
+    "0001-links-extracted.sql",
+    "0002-image-digests.sql",
+    "0003-media-canonical-keys.sql",
+    "0004-product-fetches.sql",
+    "0005-completed-searches.sql",
+    "0006-product-description-html.sql",
+    "0007-unique-searches.sql",
+    "0008-crawl-state.sql",
+)
+
 
 def create_views(cursor: sqlite3.Cursor) -> None:
     if _rollups_sql is None:
@@ -11,3 +24,22 @@ def create_views(cursor: sqlite3.Cursor) -> None:
 
     cursor.executescript(_rollups_sql.decode())
     return
+
+def migrate(cursor: sqlite3.Cursor) -> None:
+    cursor.execute("pragma user_version")
+    version, = cursor.fetchone()
+
+    for number, name in enumerate(MIGRATIONS[version:], start=version + 1):
+        migration_sql = get_data("src", f"sql/migrations/{name}")
+        if migration_sql is None:
+            raise RuntimeError(f"Failed to load migration {name}")
+
+        # Apply the migration and record it atomically.
+        cursor.executescript("\n".join([
+            "begin;",
+            migration_sql.decode(),
+            f"pragma user_version = {number};",
+            "commit;",
+        ]))
+
+    return
@@ -1,6 +1,9 @@
 import pytest
 import sqlite3
 
+from src.scrape.ratelimit import clear_limiters
+from src.utils import migrate
+
 
 with open("src/sql/schema.sql") as fh:
     setup_sql = fh.read()
@@ -9,5 +12,21 @@ with open("src/sql/schema.sql") as fh:
 def cursor():
     conn = sqlite3.connect(":memory:")
     conn.executescript(setup_sql)
+    migrate(conn.cursor())
     yield conn.cursor()
     conn.close()
+
+@pytest.fixture
+def file_cursor(tmp_path):
+    conn = sqlite3.connect(str(tmp_path / "test.db"))
+    conn.executescript(setup_sql)
+    migrate(conn.cursor())
+    yield conn.cursor()
+    conn.close()
+
+@pytest.fixture(autouse=True)
+def limiters():
+    # Rate limiters are shared by clients, so don't share them across tests.
+    clear_limiters()
+    yield
+    clear_limiters()
@@ -0,0 +1,136 @@
+from threading import Thread
+from time import sleep
+from unittest.mock import patch
+import pytest
+import requests
+import responses
+
+from src.scrape.adaptive import AdaptiveLimit, HostLimits
+from src.scrape.images import Client
+
+
+class FakeClock(object):
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def clock():
+    clock = FakeClock()
+    with patch("src.scrape.adaptive.monotonic", clock):
+        yield clock
+
+def complete(limit, clock, status, latency=1.0):
+    started = limit.acquire()
+    clock.now += latency
+    limit.release(started, status)
+
+class TestAdaptiveLimit(object):
+    def test_validates_bounds(self):
+        with pytest.raises(ValueError):
+            AdaptiveLimit(initial=4, maximum=2)
+
+    def test_increases_additively(self, clock):
+        limit = AdaptiveLimit(initial=1, maximum=8)
+        complete(limit, clock, 200)
+        assert limit.current == 2
+        # Roughly one more for each window of `limit` healthy responses.
+        for _ in range(3):
+            complete(limit, clock, 200)
+        assert limit.current == 3
+
+    def test_capped_at_maximum(self, clock):
+        limit = AdaptiveLimit(initial=1, maximum=2)
+        for _ in range(10):
+            complete(limit, clock, 200)
+        assert limit.current == 2
+
+    @pytest.mark.parametrize("status", [429, 500, 503, None])
+    def test_decreases_multiplicatively(self, clock, status):
+        limit = AdaptiveLimit(initial=8, maximum=8)
+        complete(limit, clock, status)
+        assert limit.current == 4
+
+    def test_not_below_minimum(self, clock):
+        limit = AdaptiveLimit(initial=2, minimum=2, maximum=8)
+        complete(limit, clock, 429)
+        assert limit.current == 2
+
+    def test_decreases_on_rising_latency(self, clock):
+        limit = AdaptiveLimit(initial=4, maximum=4, latency_tolerance=2)
+        complete(limit, clock, 200, latency=1)
+        complete(limit, clock, 200, latency=1.5)
+        assert limit.current == 4
+        complete(limit, clock, 200, latency=5)
+        assert limit.current == 2
+
+    def test_client_errors_are_healthy(self, clock):
+        limit = AdaptiveLimit(initial=2, maximum=8)
+        complete(limit, clock, 404)
+        assert limit.current == 2
+        assert limit.limit > 2
+
+    def test_decreases_once_for_concurrent_failures(self, clock):
+        limit = AdaptiveLimit(initial=8, maximum=8)
+        started = [limit.acquire() for _ in range(4)]
+        clock.now += 1
+        for start in started:
+            limit.release(start, 429)
+        assert limit.current == 4
+
+        # Requests started after the cut may cut again.
+        complete(limit, clock, 429)
+        assert limit.current == 2
+
+    def test_limits_in_flight(self):
+        limit = AdaptiveLimit(initial=2, maximum=2)
+        peak = 0
+
+        def work():
+            nonlocal peak
+            started = limit.acquire()
+            peak = max(peak, limit.in_flight)
+            sleep(.01)
+            limit.release(started, 200)
+
+        threads = [Thread(target=work) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert peak == 2
+        assert limit.in_flight == 0
+
+    def test_call_records_failed_request(self):
+        limit = AdaptiveLimit(initial=4, maximum=4)
+
+        def fail():
+            raise requests.ConnectionError()
+
+        with pytest.raises(requests.ConnectionError):
+            limit.call(fail)
+
+        assert limit.current == 2
+        assert limit.in_flight == 0
+
+class TestHostLimits(object):
+    def test_limit_per_host(self):
+        limits = HostLimits()
+        assert limits.get("https://a.com/x") is limits.get("https://A.com/y")
+        assert limits.get("https://a.com/x") is not limits.get("https://b.com/x")
+
+    @responses.activate
+    def test_client_reports_metrics(self):
+        responses.add(responses.GET, "https://a.com/1.jpg", body=b"data")
+        responses.add(responses.GET, "https://b.com/1.jpg", status=503)
+
+        limits = HostLimits(initial=2, maximum=4)
+        client = Client(limits=limits)
+        client.get_image("https://a.com/1.jpg")
+        client.get_image("https://b.com/1.jpg")
+
+        assert limits.metrics() == {"a.com": 2, "b.com": 1}
+        assert limits.get("https://a.com").limit > 2
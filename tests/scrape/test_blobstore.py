@@ -0,0 +1,117 @@
+from hashlib import sha256
+from unittest.mock import patch
+import mmap
+import os
+import pytest
+
+from src.scrape.blobstore import BlobStore, migrate_images, store_image
+from src.scrape.models import Image
+
+
+@pytest.fixture
+def store(tmp_path):
+    return BlobStore(tmp_path / "blobs")
+
+def make_image(img):
+    return Image(
+        id="image",
+        media_id=1,
+        album_id=None,
+        title=None,
+        description=None,
+        datetime=None,
+        type="image/jpeg",
+        link="https://i.redd.it/image.jpg",
+        views=None,
+        img=img,
+    )
+
+
+class TestBlobStore(object):
+    def test_puts_by_digest(self, store):
+        data = b"data"
+        digest = store.put(data)
+
+        assert digest == sha256(data).hexdigest()
+        assert digest in store
+        assert store.get(digest) == data
+
+    def test_shards_path(self, store):
+        digest = "abcdef"
+        expected = store.root / "ab" / "cd" / "abcdef"
+        assert store.path(digest) == expected
+
+    def test_deduplicates(self, store):
+        first = store.put(b"data")
+        second = store.put(b"data")
+
+        assert first == second
+        assert len([p for p in store.root.rglob("*") if p.is_file()]) == 1
+
+    def test_syncs_to_disk(self, store):
+        synced = []
+        fsync = os.fsync
+
+        def record(fd):
+            synced.append(os.fstat(fd).st_ino)
+            fsync(fd)
+
+        with patch("src.scrape.blobstore.os.fsync", side_effect=record):
+            digest = store.put(b"data")
+
+        # The content, its name, and the names of the new shards.
+        path = store.path(digest)
+        expected = [path, path.parent, path.parent.parent, store.root]
+        assert sorted(synced) == sorted(p.stat().st_ino for p in expected)
+
+    def test_leaves_no_temporary_files(self, store):
+        store.put(b"data")
+        names = [p.name for p in store.root.rglob("*")]
+        assert not any(name.startswith(".tmp-") for name in names)
+
+    def test_opens_memory_mapped(self, store):
+        digest = store.put(b"data")
+        mapped = store.open(digest)
+
+        assert isinstance(mapped, mmap.mmap)
+        assert mapped[:] == b"data"
+        mapped.close()
+
+    def test_opens_empty(self, store):
+        digest = store.put(b"")
+        assert store.open(digest) == b""
+
+class TestStoreImage(object):
+    def test_replaces_content_with_digest(self, store):
+        image = store_image(store, make_image(b"data"))
+
+        assert image.img is None
+        assert store.get(image.img_digest) == b"data"
+
+    def test_without_store(self):
+        image = store_image(None, make_image(b"data"))
+
+        assert image.img == b"data"
+        assert image.img_digest is None
+
+    def test_without_content(self, store):
+        image = store_image(store, make_image(None))
+        assert image.img_digest is None
+
+class TestMigrateImages(object):
+    def test_moves_blobs(self, cursor, store):
+        cursor.executemany(
+            "insert into images (id, media_id, url, img) values (?, 1, 'url', ?)",
+            [("a", b"one"), ("b", b"two"), ("c", b"one"), ("d", None)]
+        )
+
+        n_migrated = migrate_images(cursor, store, batch_size=2)
+        cursor.execute("select id, img, img_digest from images order by id")
+        rows = cursor.fetchall()
+
+        assert n_migrated == 3
+        assert all(img is None for _, img, _ in rows)
+        digests = {id_: digest for id_, _, digest in rows}
+        assert digests["a"] == digests["c"]
+        assert digests["d"] is None
+        assert store.get(digests["b"]) == b"two"
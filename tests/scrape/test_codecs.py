@@ -0,0 +1,107 @@
+from dataclasses import dataclass
+import sqlite3
+
+from src.scrape.codecs import decoder, encoder, field_names, init_field_names, to_row
+from src.scrape.models import Album, Image, Media
+
+
+@dataclass
+class Blob:
+    data: bytes
+
+
+def make_image(img):
+    return Image(
+        id="image",
+        media_id=1,
+        album_id=None,
+        title=None,
+        description=None,
+        datetime=1_500_000_000,
+        type="image/jpeg",
+        link="https://i.imgur.com/image.jpg",
+        views=0,
+        img=img,
+    )
+
+
+class TestFieldNames(object):
+    def test_excludes_init_vars(self):
+        names = field_names(Image)
+        assert "datetime" not in names
+        assert "uploaded_utc" in names
+
+class TestEncoder(object):
+    def test_is_cached(self):
+        assert encoder(Media) is encoder(Media)
+
+    def test_single_field(self):
+        assert to_row(Blob(b"data")) == (b"data",)
+
+class TestToRow(object):
+    def test_orders_by_field(self):
+        media = Media(submission_id="s_id", url="url", is_direct=True, txt=None)
+        assert to_row(media) == ("s_id", "url", True, None)
+
+    def test_does_not_copy_bytes(self):
+        img = b"data" * 1_000
+        row = to_row(make_image(img))
+        assert row[field_names(Image).index("img")] is img
+
+    def test_passes_memoryview(self):
+        img = memoryview(b"data")
+        row = to_row(make_image(img))
+        assert row[field_names(Image).index("img")] is img
+
+    def test_memoryview_is_stored(self):
+        conn = sqlite3.connect(":memory:")
+        conn.execute("create table blobs (data blob)")
+
+        conn.execute("insert into blobs values (?)", to_row(Blob(memoryview(b"data"))))
+        stored, = conn.execute("select data from blobs").fetchone()
+        conn.close()
+
+        assert stored == b"data"
+
+class TestInitFieldNames(object):
+    def test_includes_init_vars(self):
+        names = init_field_names(Album)
+        assert "datetime" in names
+        assert "link" in names
+
+    def test_excludes_derived_fields(self):
+        names = init_field_names(Album)
+        assert "uploaded_utc" not in names
+        assert "url" not in names
+
+class TestDecoder(object):
+    data = {
+        "id": "album",
+        "media_id": 1,
+        "title": "Title",
+        "description": None,
+        "datetime": 1_500_000_000,
+        "link": "https://imgur.com/a/album",
+        "views": 10,
+    }
+
+    def test_is_cached(self):
+        assert decoder(Album) is decoder(Album)
+
+    def test_matches_constructor(self):
+        album = decoder(Album)(self.data)
+        assert album == Album(**self.data)
+
+    def test_applies_renames(self):
+        album = decoder(Album)(self.data)
+        assert album.uploaded_utc == self.data["datetime"]
+        assert album.url == self.data["link"]
+
+    def test_ignores_unknown_keys(self):
+        album = decoder(Album)({**self.data, "unused": "unused"})
+        assert album == Album(**self.data)
+
+    def test_defaults_missing_keys(self):
+        data = {k: v for k, v in self.data.items() if k != "title"}
+        album = decoder(Album)(data)
+        assert album.title is None
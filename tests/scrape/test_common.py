@@ -1,8 +1,19 @@
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import InitVar, dataclass, field
+from threading import Lock
+from time import sleep
 import pytest
 import sqlite3
 
-from src.scrape.common import from_json, insert_or_ignore, is_media_url
+from src.scrape.common import (
+    BulkWriter,
+    concurrent_map,
+    from_json,
+    insert_or_ignore,
+    insert_statement,
+    is_media_url,
+    ordered_map,
+)
 
 
 @dataclass
@@ -84,6 +95,149 @@ class TestInsertOrIgnore(object):
 
         assert len(results) == 0
 
+class TestInsertStatement(object):
+    def test_targets_model_fields(self):
+        sql = insert_statement("posts", Post)
+        assert sql == "insert or ignore into posts (author, content) values (?, ?)"
+
+    def test_is_cached(self):
+        assert insert_statement("posts", Post) is insert_statement("posts", Post)
+
+class TestBulkWriter(object):
+    table = "posts"
+
+    def count(self, cursor):
+        cursor.execute(f"select count(*) from {self.table}")
+        return cursor.fetchone()[0]
+
+    def test_flushes_full_batches(self, cursor):
+        writer = BulkWriter(cursor, self.table, batch_size=2)
+        for i in range(3):
+            writer.add(Post(user="user", content=str(i)))
+
+        assert self.count(cursor) == 2
+        writer.flush()
+        assert self.count(cursor) == 3
+        assert writer.count == 3
+
+    def test_flushes_on_exit(self, cursor):
+        with BulkWriter(cursor, self.table) as writer:
+            writer.add(Post(user="user", content="content"))
+            assert self.count(cursor) == 0
+
+        assert self.count(cursor) == 1
+
+    def test_flushes_on_non_database_error(self, cursor):
+        with pytest.raises(RuntimeError):
+            with BulkWriter(cursor, self.table) as writer:
+                writer.add(Post(user="user", content="content"))
+                raise RuntimeError
+
+        assert self.count(cursor) == 1
+
+    def test_ignores(self, cursor):
+        with BulkWriter(cursor, self.table) as writer:
+            writer.add(Post(user="user", content=None))
+            writer.add(Post(user="user", content="content"))
+
+        assert self.count(cursor) == 1
+
+    def test_rejects_mixed_models(self, cursor):
+        writer = BulkWriter(cursor, self.table)
+        writer.add(Post(user="user", content="content"))
+
+        with pytest.raises(TypeError):
+            writer.add(("user", "content"))
+
+    def test_rejects_empty_batches(self, cursor):
+        with pytest.raises(ValueError):
+            BulkWriter(cursor, self.table, batch_size=0)
+
+class TestConcurrentMap(object):
+    @pytest.mark.parametrize("workers", [1, 4])
+    def test_maps_all_items(self, workers):
+        results = concurrent_map(lambda x: x * 2, range(20), workers)
+        assert sorted(results) == [x * 2 for x in range(20)]
+
+    def test_bounds_items_in_flight(self):
+        workers = 2
+        lock = Lock()
+        started = []
+
+        def items():
+            for i in range(20):
+                with lock:
+                    started.append(i)
+                yield i
+
+        def fn(x):
+            sleep(.001)
+            return x
+
+        for n_done, _ in enumerate(concurrent_map(fn, items(), workers), start=1):
+            with lock:
+                assert len(started) - n_done <= 2 * workers
+
+    def test_raises_errors(self):
+        def fn(x):
+            if x == 3:
+                raise ValueError
+            return x
+
+        with pytest.raises(ValueError):
+            list(concurrent_map(fn, range(10), workers=2))
+
+    def test_drops_unstarted_items_on_error(self):
+        calls = []
+
+        def fn(x):
+            calls.append(x)
+            if x == 0:
+                raise ValueError
+            sleep(.01)
+            return x
+
+        with pytest.raises(ValueError):
+            list(concurrent_map(fn, range(100), workers=2))
+
+        assert len(calls) < 100
+
+class TestOrderedMap(object):
+    def test_maps_in_order(self):
+        def fn(x):
+            # Later items finish first.
+            sleep((20 - x) / 10_000)
+            return x * 2
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            results = list(ordered_map(executor, fn, range(20), max_pending=8))
+
+        assert results == [x * 2 for x in range(20)]
+
+    def test_bounds_items_in_flight(self):
+        max_pending = 3
+        started = []
+
+        def items():
+            for i in range(20):
+                started.append(i)
+                yield i
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            results = ordered_map(executor, lambda x: x, items(), max_pending)
+            for n_done, _ in enumerate(results, start=1):
+                assert len(started) - n_done <= max_pending
+
+    def test_raises_errors(self):
+        def fn(x):
+            if x == 3:
+                raise ValueError
+            return x
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            with pytest.raises(ValueError):
+                list(ordered_map(executor, fn, range(10), max_pending=4))
+
 class TestIsMediaURL(object):
     @pytest.mark.parametrize("url", [
         "https://imgur.com/a/ABCDEFG",
@@ -1,6 +1,31 @@
 import html
+import pytest
 
-from src.scrape.extract_links import extract
+from src.scrape.extract_links import (
+    ANCHOR_PARSERS,
+    database_path,
+    extract,
+    ingest,
+    iter_submission_contents,
+    parser_anchors,
+    rowid_ranges,
+    soup_anchors,
+)
+
+
+def insert_submission(cursor, s_id, selftext_html):
+    cursor.execute(
+        """
+        insert into submissions
+        values (?, '', '', '', '', ?, 1, ?, 0, 0, 0, 0, 0, 'query', 1)
+        """,
+        (s_id, s_id, selftext_html)
+    )
+    return
+
+@pytest.fixture(params=sorted(ANCHOR_PARSERS))
+def parser(request):
+    return request.param
 
 
 class TestExtract(object):
@@ -15,25 +40,157 @@ class TestExtract(object):
         """
     )
 
-    def test_extracts_media_links(self):
+    def test_extracts_media_links(self, parser):
         expected_urls = [
             "https://imgur.com/a/ABCDEFG",
             "https://i.redd.it/direct.jpg",
         ]
         expected_txts = ["Album first", "here"]
 
-        medias = extract("s_id", self.doc)
+        medias = extract("s_id", self.doc, parser)
         urls = [media.url for media in medias]
         txts = [media.txt for media in medias]
 
         assert urls == expected_urls
         assert txts == expected_txts
 
-    def test_propagates_submission_id(self):
+    def test_propagates_submission_id(self, parser):
         submission_id = "s_id"
-        medias = extract(submission_id, self.doc)
+        medias = extract(submission_id, self.doc, parser)
         assert all(media.submission_id == submission_id for media in medias)
 
-    def test_never_direct(self):
-        medias = extract("s_id", self.doc)
+    def test_never_direct(self, parser):
+        medias = extract("s_id", self.doc, parser)
         assert all(not media.is_direct for media in medias)
+
+class TestAnchorParsers(object):
+    @pytest.mark.parametrize(
+        "raw", [
+            '<a href="https://imgur.com/a/foo">Album</a>',
+            '<p><a href="https://imgur.com/a/foo"><strong>Bold</strong> album</a></p>',
+            '<a href="https://imgur.com/a/foo?a=1&amp;b=2">Fish &amp; chips</a>',
+            '<a name="anchor">Nothing</a><a href="https://imgur.com/a/foo">Album</a>',
+            (
+                '<a href="https://imgur.com/a/foo">Outer '
+                '<a href="https://i.redd.it/x">inner</a></a>'
+            ),
+            '<a href="https://imgur.com/a/foo">Unclosed',
+            "<p>No links at all.</p>",
+        ], ids=["plain", "markup", "entities", "no_href", "nested", "unclosed", "none"]
+    )
+    def test_parsers_agree(self, raw):
+        assert parser_anchors(raw) == soup_anchors(raw)
+
+    def test_skips_anchors_without_href(self, parser):
+        doc = html.escape('<a name="top">Top</a>')
+        assert extract("s_id", doc, parser) == []
+
+class TestIterSubmissionContents(object):
+    def test_chunks(self, cursor):
+        for i in range(5):
+            insert_submission(cursor, f"s{i}", "body")
+
+        chunks = list(iter_submission_contents(cursor, chunk_size=2))
+
+        assert [len(chunk) for chunk in chunks] == [2, 2, 1]
+
+    def test_skips_empty_bodies(self, cursor):
+        insert_submission(cursor, "s0", None)
+        insert_submission(cursor, "s1", "body")
+
+        chunks = list(iter_submission_contents(cursor, chunk_size=2))
+
+        assert chunks == [[("s1", "body")]]
+
+class TestRowidRanges(object):
+    def test_covers_rowids(self, cursor):
+        for i in range(5):
+            insert_submission(cursor, f"s{i}", "body")
+
+        ranges = rowid_ranges(cursor, chunk_size=2)
+
+        assert ranges == [(1, 2), (3, 4), (5, 5)]
+
+    def test_empty(self, cursor):
+        assert rowid_ranges(cursor, chunk_size=2) == []
+
+class TestDatabasePath(object):
+    def test_in_memory(self, cursor):
+        assert database_path(cursor) == ""
+
+    def test_on_disk(self, file_cursor, tmp_path):
+        assert database_path(file_cursor) == str(tmp_path / "test.db")
+
+class TestIngest(object):
+    def test_writes_medias(self, cursor):
+        for i in range(3):
+            insert_submission(cursor, f"s{i}", TestExtract.doc)
+
+        n_processed = ingest(cursor, chunk_size=2)
+        cursor.execute("select submission_id, url from medias order by id")
+        medias = cursor.fetchall()
+
+        assert n_processed == 3
+        assert len(medias) == 6
+        assert medias[0] == ("s0", "https://imgur.com/a/ABCDEFG")
+
+    def test_commits_chunks(self, cursor):
+        for i in range(3):
+            insert_submission(cursor, f"s{i}", TestExtract.doc)
+
+        ingest(cursor, chunk_size=2)
+        cursor.connection.rollback()
+        cursor.execute("select count(*) from medias")
+
+        assert cursor.fetchone()[0] == 6
+
+    def test_parallel_matches_serial(self, cursor, file_cursor):
+        for c in (cursor, file_cursor):
+            for i in range(5):
+                insert_submission(c, f"s{i}", TestExtract.doc)
+            c.connection.commit()
+
+        query = "select submission_id, url, is_direct, txt from medias order by id"
+        ingest(cursor, chunk_size=2)
+        ingest(file_cursor, chunk_size=2, workers=2, parser="stdlib")
+
+        cursor.execute(query)
+        file_cursor.execute(query)
+        assert file_cursor.fetchall() == cursor.fetchall()
+
+    def test_parallel_requires_file(self, cursor):
+        with pytest.raises(ValueError):
+            ingest(cursor, workers=2)
+
+    def test_skips_processed_submissions(self, cursor):
+        insert_submission(cursor, "s0", TestExtract.doc)
+        ingest(cursor)
+        insert_submission(cursor, "s1", TestExtract.doc)
+
+        n_processed = ingest(cursor)
+        cursor.execute("select submission_id, count(*) from medias group by 1")
+        counts = cursor.fetchall()
+
+        assert n_processed == 1
+        assert counts == [("s0", 2), ("s1", 2)]
+
+    def test_marks_submissions_without_links(self, cursor):
+        insert_submission(cursor, "s0", "No links.")
+
+        ingest(cursor)
+        cursor.execute("select submission_id from links_extracted")
+
+        assert cursor.fetchall() == [("s0",)]
+
+    def test_parallel_skips_processed_submissions(self, file_cursor):
+        insert_submission(file_cursor, "s0", TestExtract.doc)
+        file_cursor.connection.commit()
+        ingest(file_cursor, workers=2)
+        insert_submission(file_cursor, "s1", TestExtract.doc)
+        file_cursor.connection.commit()
+
+        n_processed = ingest(file_cursor, workers=2)
+        file_cursor.execute("select count(*) from medias")
+
+        assert n_processed == 1
+        assert file_cursor.fetchone()[0] == 4
@@ -1,12 +1,19 @@
 from requests import HTTPError
+from threading import Lock, Thread
+from time import sleep, time
 import json
 import pytest
 import responses
+import tracemalloc
 
+from src.scrape.blobstore import BlobStore
+from src.scrape.common import from_json
 from src.scrape.images import (
+    ByteBudget,
     Client,
     ImgurClient,
     RateLimitError,
+    canonical_media_key,
     get_id,
     get_links,
     ingest_albums,
@@ -17,6 +24,8 @@ from src.scrape.images import (
     sniff_imgur_resource,
     strip_imgur_subdomain,
 )
+from src.scrape.models import Image
+from src.utils import create_views
 
 
 @pytest.fixture
@@ -78,6 +87,59 @@ def insert_media(cursor, m_id, s_id, url):
     )
     return
 
+class SyntheticAlbumClient(ImgurClient):
+    """Serves an album of generated images, without any HTTP."""
+
+    def __init__(self, n_images, image_size, **kwds):
+        super().__init__("test", **kwds)
+        self.n_images = n_images
+        self.image_size = image_size
+        self.n_started = 0
+        self._started_lock = Lock()
+
+    def get_json(self, url):
+        images = [
+            {
+                "id": str(i),
+                "link": f"https://mock-imgur.com/{i}.jpg",
+                "datetime": 1_500_000_000,
+                "views": 0,
+                "size": self.image_size,
+            }
+            for i in range(self.n_images)
+        ]
+        data = {
+            "id": "album",
+            "datetime": 1_500_000_000,
+            "link": "https://mock-imgur.com/a/album",
+            "views": 0,
+            "images": images,
+        }
+        return {"data": data}
+
+    def get_image(self, url, **metadata):
+        with self._started_lock:
+            self.n_started += 1
+        data = {
+            **metadata,
+            "type": "image/jpeg",
+            "img": bytes(self.image_size),
+            "link": url,
+        }
+        return from_json(Image, **data)
+
+class RateLimitedAlbumClient(SyntheticAlbumClient):
+    """Is rate limited when getting one of the album's images."""
+
+    def __init__(self, n_images, image_size, fail_on, **kwds):
+        super().__init__(n_images, image_size, **kwds)
+        self.fail_on = fail_on
+
+    def get_image(self, url, **metadata):
+        if metadata["id"] == self.fail_on:
+            self.stop("Rate limited by Imgur")
+        return super().get_image(url, **metadata)
+
 
 class TestSniffImgurResource(object):
     @pytest.mark.parametrize(
@@ -208,6 +270,41 @@ class TestIsAlbum(object):
     def test_not_album(self, url):
         assert not is_album(url)
 
+class TestCanonicalMediaKey(object):
+    @pytest.mark.parametrize(
+        "url", [
+            "https://i.imgur.com/ABCDEFG.jpg",
+            "https://m.imgur.com/ABCDEFG",
+            "https://imgur.com/ABCDEFG#anchor",
+            "https://imgur.com/ABCDEFG/",
+        ], ids=["direct", "mobile", "anchor", "trailing"]
+    )
+    def test_imgur_image_forms(self, url):
+        assert canonical_media_key(url) == "imgur/image/ABCDEFG"
+
+    def test_imgur_album(self):
+        urls = ["https://imgur.com/a/ABCDEFG", "https://m.imgur.com/a/ABCDEFG#0"]
+        keys = {canonical_media_key(url) for url in urls}
+        assert keys == {"imgur/album/ABCDEFG"}
+
+    def test_album_and_image_differ(self):
+        album = canonical_media_key("https://imgur.com/a/ABCDEFG")
+        image = canonical_media_key("https://imgur.com/ABCDEFG")
+        assert album != image
+
+    def test_reddit(self):
+        key = canonical_media_key("https://i.redd.it/ABCDEFG.jpg")
+        assert key == "i.redd.it/ABCDEFG"
+
+    @pytest.mark.parametrize(
+        "url", [
+            "https://imgur.com/",
+            "https://imgur.com/unknown/ABCDEFG",
+        ], ids=["no_path", "unknown_resource"]
+    )
+    def test_falls_back_to_url(self, url):
+        assert canonical_media_key(url) == url
+
 class TestGetLinks(object):
     def test_unprocessed_links(self, cursor):
         # `medias` has a FK constraint on `submissions.id`.
@@ -234,6 +331,59 @@ class TestGetLinks(object):
 
         assert medias == expected
 
+    def test_refetches_incomplete_albums(self, cursor):
+        insert_submission(cursor, "s_id")
+        insert_media(cursor, 1, "s_id", "https://imgur.com/a/foo")
+        insert_media(cursor, 2, "s_id", "https://imgur.com/a/bar")
+        # Both albums have an image, but only the second was completed.
+        cursor.execute(
+            """
+            insert into images (id, media_id, album_id, url)
+            values
+                ('1', 1, 'foo', 'https://imgur.com/1.jpg'),
+                ('2', 2, 'bar', 'https://imgur.com/2.jpg')
+            """
+        )
+        cursor.execute(
+            """
+            insert into albums (id, media_id, uploaded_utc, url, views)
+            values ('bar', 2, 0, 'https://imgur.com/a/bar', 0)
+            """
+        )
+
+        assert get_links(cursor) == [(1, "https://imgur.com/a/foo")]
+
+    def test_fetches_resource_once(self, cursor):
+        insert_submission(cursor, "s_id")
+        insert_media(cursor, 1, "s_id", "https://i.imgur.com/foo.jpg")
+        insert_media(cursor, 2, "s_id", "https://m.imgur.com/foo")
+        insert_media(cursor, 3, "s_id", "https://imgur.com/a/bar")
+
+        medias = get_links(cursor)
+
+        assert medias == [
+            (1, "https://i.imgur.com/foo.jpg"),
+            (3, "https://imgur.com/a/bar"),
+        ]
+
+    def test_skips_resources_fetched_through_another_media(self, cursor):
+        insert_submission(cursor, "s_id")
+        insert_media(cursor, 1, "s_id", "https://i.imgur.com/foo.jpg")
+        cursor.execute(
+            """
+            insert into images (id, media_id, url)
+            values ('foo', 1, 'https://imgur.com/foo.jpg')
+            """
+        )
+        get_links(cursor)
+        insert_media(cursor, 2, "s_id", "https://imgur.com/foo")
+
+        assert get_links(cursor) == []
+
+        create_views(cursor)
+        cursor.execute("select media_id, image_id from media_images order by 1")
+        assert cursor.fetchall() == [(1, "foo"), (2, "foo")]
+
 class TestClient(object):
     url = "https://mock-imgur.com/image.jpg"
     body = b"data"
@@ -335,6 +485,38 @@ class TestImgurClient(object):
             client = ImgurClient("test")
             client.get_album(url, media_id=1)
 
+    @responses.activate
+    def test_stops_after_rate_limit(self):
+        url = "https://mock-imgur.com/a/foo"
+        responses.add(responses.GET, url, status=429)
+
+        client = ImgurClient("test")
+        with pytest.raises(RateLimitError):
+            client.get_json(url)
+        with pytest.raises(RateLimitError):
+            client.get_json(url)
+
+        assert len(responses.calls) == 1
+
+    @responses.activate
+    def test_stops_when_rate_limit_wait_is_too_long(self):
+        url = "https://mock-imgur.com/a/foo"
+        reset = str(int(time()) + 60 * 60)
+        responses.add(
+            responses.GET,
+            url,
+            json={"data": {}},
+            headers={"X-RateLimit-UserRemaining": "0", "X-RateLimit-UserReset": reset},
+        )
+
+        client = ImgurClient("test")
+        client.min_stopping_credits = -1
+        client.get_json(url)
+        with pytest.raises(RateLimitError):
+            client.get_json(url)
+
+        assert len(responses.calls) == 1
+
     @responses.activate
     def test_gets_album(self, imgur_album):
         imgur_album, url = add_album_response(imgur_album, img_body=b"data")
@@ -349,6 +531,92 @@ class TestImgurClient(object):
         assert all(image.album_id == album.id for image in images)
         assert all(image.media_id == 1 for image in images)
 
+    @responses.activate
+    def test_gets_album_concurrently_in_order(self, imgur_album):
+        imgur_album, url = add_album_response(imgur_album, img_body=b"data")
+        album_data = imgur_album["data"]
+
+        client = ImgurClient("test", album_concurrency=4)
+        album, images = client.get_album(url, media_id=1)
+
+        expected_ids = [img["id"] for img in album_data["images"]]
+        assert [image.id for image in images] == expected_ids
+
+    @responses.activate
+    def test_get_album_fails_soft_per_image(self, imgur_album):
+        imgur_album, url = add_album_response(imgur_album, img_body=b"data")
+        failed = imgur_album["data"]["images"][1]
+        responses.replace(responses.GET, failed["link"], status=404)
+
+        client = ImgurClient("test", album_concurrency=4)
+        album, images = client.get_album(url, media_id=1)
+
+        assert len(images) == len(imgur_album["data"]["images"])
+        assert images[1].img is None
+        assert all(image.img == b"data" for i, image in enumerate(images) if i != 1)
+
+class TestByteBudget(object):
+    def test_blocks_until_released(self):
+        budget = ByteBudget(10)
+        budget.acquire(8)
+
+        thread = Thread(target=budget.acquire, args=(8,))
+        thread.start()
+        sleep(.01)
+        assert thread.is_alive()
+
+        budget.release(8)
+        thread.join(timeout=1)
+        assert not thread.is_alive()
+        assert budget.in_flight == 8
+
+    def test_admits_oversized_when_empty(self):
+        budget = ByteBudget(10)
+        budget.acquire(100)
+        assert budget.in_flight == 100
+
+    def test_close_unblocks(self):
+        budget = ByteBudget(10)
+        budget.acquire(10)
+
+        thread = Thread(target=budget.acquire, args=(10,))
+        thread.start()
+        budget.close()
+        thread.join(timeout=1)
+
+        assert not thread.is_alive()
+
+class TestStreamAlbum(object):
+    def test_streams_all_images(self):
+        client = SyntheticAlbumClient(20, 10, album_concurrency=4)
+        album, images = client.stream_album("url", media_id=1, max_bytes=50)
+
+        ids = sorted(int(image.id) for image in images)
+
+        assert album.id == "album"
+        assert ids == list(range(20))
+
+    def test_reserves_room_before_downloading(self):
+        client = SyntheticAlbumClient(20, 10, album_concurrency=4)
+        _, images = client.stream_album("url", media_id=1, max_bytes=20)
+
+        try:
+            for n_consumed, _ in enumerate(images):
+                # Give downloads the chance to get ahead.
+                sleep(.005)
+                # Room for two images, plus those already consumed.
+                assert client.n_started <= n_consumed + 2
+        finally:
+            images.close()
+
+    def test_stops_downloads_when_closed(self):
+        client = SyntheticAlbumClient(100, 10, album_concurrency=2)
+        _, images = client.stream_album("url", media_id=1, max_bytes=10)
+
+        next(images)
+        # Must not hang on downloads waiting for room.
+        images.close()
+
 class TestIngestStandalones(object):
     @responses.activate
     def test_reddit_standalone(self, cursor):
@@ -426,6 +694,67 @@ class TestIngestStandalones(object):
         records = cursor.fetchall()
         assert records == expected
 
+    @responses.activate
+    def test_standalone_to_blob_store(self, cursor, tmp_path):
+        url = "https://mock.i.redd.it/image.jpg"
+        add_image(url, b"data")
+        insert_submission(cursor, "s_id")
+        insert_media(cursor, 1, "s_id", url)
+
+        store = BlobStore(tmp_path)
+        ingest_standalones(cursor, Client(), ImgurClient("test"), [(1, url)], store=store)
+
+        cursor.execute("select img, img_digest from images")
+        img, digest = cursor.fetchone()
+        assert img is None
+        assert store.get(digest) == b"data"
+
+    @responses.activate
+    def test_concurrent_standalones(self, cursor):
+        insert_submission(cursor, "s_id")
+        medias = []
+        for i in range(8):
+            url = f"https://mock.i.redd.it/{i}.jpg"
+            add_image(url, f"{i}".encode())
+            insert_media(cursor, i + 1, "s_id", url)
+            medias.append((i + 1, url))
+
+        client = Client()
+        imgur_client = ImgurClient("test")
+        ingest_standalones(cursor, client, imgur_client, medias, concurrency=4)
+
+        cursor.execute("select id, media_id, img from images order by media_id")
+        records = cursor.fetchall()
+        assert records == [(str(i), i + 1, f"{i}".encode()) for i in range(8)]
+
+    @responses.activate
+    def test_rate_limit_stops_all_workers(self, cursor):
+        insert_submission(cursor, "s_id")
+        medias = []
+        for i in range(8):
+            url = f"https://mock-imgur/{i}.jpg"
+            add_image(url, b"data")
+            responses.add(
+                responses.GET,
+                f"https://api.imgur.com/3/image/{i}",
+                json={"data": {"id": str(i), "link": url}},
+                headers={"X-RateLimit-ClientRemaining": "0"},
+            )
+            insert_media(cursor, i + 1, "s_id", url)
+            medias.append((i + 1, url))
+
+        client = Client()
+        imgur_client = ImgurClient("test")
+        with pytest.raises(RateLimitError):
+            ingest_standalones(cursor, client, imgur_client, medias, concurrency=2)
+
+        assert imgur_client.rate_limited.is_set()
+        # Workers stop making requests once the limit is reached.
+        n_metadata_requests = sum(
+            "api.imgur.com" in call.request.url for call in responses.calls
+        )
+        assert n_metadata_requests <= 2
+
 class TestIngestAlbums(object):
     @responses.activate
     def test_imgur_album(self, cursor, imgur_album):
@@ -476,3 +805,60 @@ class TestIngestAlbums(object):
         )
         images = cursor.fetchall()
         assert images == expected_images
+
+    def test_large_album_is_memory_bounded(self, cursor):
+        n_images = 500
+        image_size = 64 * 1024
+        max_bytes = 1024 * 1024
+        # All of the images would take up 32 MB.
+        ceiling = 8 * 1024 * 1024
+
+        url = "https://imgur.com/a/album"
+        insert_submission(cursor, "s_id")
+        insert_media(cursor, 1, "s_id", url)
+        client = SyntheticAlbumClient(n_images, image_size, album_concurrency=4)
+
+        tracemalloc.start()
+        try:
+            ingest_albums(cursor, client, [(1, url)], max_bytes=max_bytes)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        cursor.execute("select count(*), sum(length(img)) from images")
+        count, total_bytes = cursor.fetchone()
+        assert count == n_images
+        assert total_bytes == n_images * image_size
+        assert peak < ceiling
+
+    def test_interrupted_album_is_not_kept(self, cursor):
+        url = "https://imgur.com/a/album"
+        insert_submission(cursor, "s_id")
+        insert_media(cursor, 1, "s_id", url)
+        client = RateLimitedAlbumClient(5, 10, fail_on="2", album_concurrency=1)
+
+        with pytest.raises(RateLimitError):
+            ingest_albums(cursor, client, [(1, url)])
+        # Progress is saved on a rate limit.
+        cursor.connection.commit()
+
+        cursor.execute("select count(*) from albums")
+        assert cursor.fetchone()[0] == 0
+        cursor.execute("select count(*) from images")
+        assert cursor.fetchone()[0] == 0
+        assert get_links(cursor) == [(1, url)]
+
+    def test_album_to_blob_store(self, cursor, tmp_path):
+        url = "https://imgur.com/a/album"
+        insert_submission(cursor, "s_id")
+        insert_media(cursor, 1, "s_id", url)
+        client = SyntheticAlbumClient(5, 10, album_concurrency=2)
+
+        store = BlobStore(tmp_path)
+        ingest_albums(cursor, client, [(1, url)], max_bytes=10, store=store)
+
+        cursor.execute("select count(*) from images where img is null")
+        assert cursor.fetchone()[0] == 5
+        cursor.execute("select distinct img_digest from images")
+        digest, = cursor.fetchone()
+        assert store.get(digest) == bytes(10)
@@ -0,0 +1,211 @@
+from time import time
+from unittest.mock import patch
+import pytest
+import threading
+
+from src.scrape.ratelimit import (
+    TokenBucket,
+    imgur_limit,
+    most_constraining,
+    reddit_limit,
+    shared_limiter,
+    zappos_limit,
+)
+
+
+class FakeClock(object):
+    """Stand in for `monotonic` and `sleep`, with sleeping advancing time."""
+
+    def __init__(self) -> None:
+        self.now = 0.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+@pytest.fixture
+def clock():
+    clock = FakeClock()
+    with patch("src.scrape.ratelimit.monotonic", clock.monotonic), \
+            patch("src.scrape.ratelimit.sleep", lambda s: clock.sleep(s)):
+        yield clock
+
+class TestTokenBucket(object):
+    def test_lets_burst_through(self, clock):
+        bucket = TokenBucket(rate=1, capacity=3)
+        for _ in range(3):
+            assert bucket.acquire()
+        assert clock.sleeps == []
+
+    def test_paces_after_burst(self, clock):
+        bucket = TokenBucket(rate=2, capacity=1)
+        for _ in range(3):
+            bucket.acquire()
+        assert clock.sleeps == [pytest.approx(.5), pytest.approx(.5)]
+
+    def test_refills_up_to_capacity(self, clock):
+        bucket = TokenBucket(rate=1, capacity=2)
+        bucket.acquire()
+        bucket.acquire()
+        clock.now += 100
+        for _ in range(3):
+            bucket.acquire()
+        assert clock.sleeps == [pytest.approx(1)]
+
+    def test_timeout(self, clock):
+        bucket = TokenBucket(rate=1, capacity=1)
+        bucket.acquire()
+        assert not bucket.acquire(timeout=.5)
+        # Nothing was taken by the failed attempt.
+        assert bucket.acquire(timeout=1)
+        assert clock.sleeps == [pytest.approx(1)]
+
+    def test_update_spreads_remaining(self, clock):
+        bucket = TokenBucket(rate=10, capacity=5)
+        bucket.update(remaining=2, reset_seconds=4)
+        for _ in range(3):
+            bucket.acquire()
+        # Two requests remain, then wait for a token at half a request
+        # per second.
+        assert clock.sleeps == [pytest.approx(2)]
+
+    def test_update_never_raises_rate(self, clock):
+        bucket = TokenBucket(rate=1, capacity=1)
+        bucket.update(remaining=100, reset_seconds=1)
+        bucket.acquire()
+        bucket.acquire()
+        assert clock.sleeps == [pytest.approx(1)]
+
+    def test_waits_for_reset_when_exhausted(self, clock):
+        bucket = TokenBucket(rate=2, capacity=5)
+        bucket.update(remaining=0, reset_seconds=10)
+        bucket.acquire()
+        # Wait out the reset, then for a token at the starting rate.
+        assert clock.sleeps == [pytest.approx(10.5)]
+
+    def test_rate_restored_after_reset(self, clock):
+        bucket = TokenBucket(rate=2, capacity=1)
+        bucket.update(remaining=1, reset_seconds=10)
+        bucket.acquire()
+        clock.now += 20
+        bucket.acquire()
+        bucket.acquire()
+        assert clock.sleeps == [pytest.approx(.5)]
+
+    def test_ignores_past_reset(self, clock):
+        bucket = TokenBucket(rate=1, capacity=2)
+        bucket.update(remaining=0, reset_seconds=-1)
+        bucket.acquire()
+        assert clock.sleeps == []
+
+    def test_concurrent_callers_are_paced(self, clock):
+        # Callers all arrive at once, before any of them is done waiting.
+        clock.sleep = clock.sleeps.append
+        bucket = TokenBucket(rate=1, capacity=1)
+        threads = [threading.Thread(target=bucket.acquire) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # Each waiting caller reserves its own token.
+        assert sorted(clock.sleeps) == [
+            pytest.approx(seconds) for seconds in (1, 2, 3, 4)
+        ]
+
+class TestMostConstraining(object):
+    def test_lowest_rate(self):
+        assert most_constraining([(10, 10), (100, 1_000)]) == (100, 1_000)
+
+    def test_ignores_past_resets(self):
+        assert most_constraining([(0, -1), (5, 10)]) == (5, 10)
+        assert most_constraining([(0, -1)]) is None
+
+class TestReddit(object):
+    def test_limit(self):
+        headers = {
+            "X-Ratelimit-Used": "5",
+            "X-Ratelimit-Remaining": "595.0",
+            "X-Ratelimit-Reset": "300",
+        }
+        assert reddit_limit(headers) == (595, 300)
+
+    def test_missing(self):
+        assert reddit_limit({}) is None
+
+class TestImgur(object):
+    def test_user_limit(self):
+        headers = {
+            "X-RateLimit-UserRemaining": "10",
+            "X-RateLimit-UserReset": str(int(time()) + 100),
+            "X-RateLimit-ClientRemaining": "12000",
+        }
+        remaining, reset_seconds = imgur_limit(headers)
+        assert remaining == 10
+        assert 0 < reset_seconds <= 100
+
+    def test_client_limit(self):
+        headers = {
+            "X-RateLimit-UserRemaining": "400",
+            "X-RateLimit-UserReset": str(int(time()) + 3_600),
+            "X-RateLimit-ClientRemaining": "1",
+        }
+        remaining, reset_seconds = imgur_limit(headers)
+        assert remaining == 1
+        assert reset_seconds == 24 * 60 * 60
+
+class TestZappos(object):
+    def test_unconstrained_without_resets(self):
+        headers = {
+            "X-RateLimit-Short-RateRemaining": "4",
+            "X-RateLimit-Long-RateRemaining": "2000",
+        }
+        assert zappos_limit(headers) is None
+
+    def test_when_short_limit_is_low(self):
+        ms = int(time() * 1000) + 100_000
+        headers = {
+            "X-RateLimit-Short-RateRemaining": "1",
+            "X-RateLimit-Short-RateReset": str(ms),
+            "X-RateLimit-Long-RateRemaining": "2000",
+        }
+        remaining, reset_seconds = zappos_limit(headers)
+        assert remaining == 1
+        assert 0 < reset_seconds <= 100
+
+    def test_when_long_limit_is_low(self):
+        ms = int(time() * 1000) + 100_000
+        headers = {
+            "X-RateLimit-Short-RateRemaining": "4",
+            "X-RateLimit-Short-RateReset": str(int(time() * 1000) + 1_000),
+            "X-RateLimit-Long-RateRemaining": "1",
+            "X-RateLimit-Long-RateReset": str(ms),
+        }
+        remaining, reset_seconds = zappos_limit(headers)
+        assert remaining == 1
+        assert reset_seconds > 1
+
+    def test_ignores_past_reset(self):
+        ms = int(time() * 1000) + 100_000
+        headers = {
+            "X-RateLimit-Short-RateRemaining": "1",
+            "X-RateLimit-Short-RateReset": "-1000",
+            "X-RateLimit-Long-RateRemaining": "1",
+            "X-RateLimit-Long-RateReset": str(ms),
+        }
+        remaining, reset_seconds = zappos_limit(headers)
+        assert remaining == 1
+        assert reset_seconds > 1
+
+class TestSharedLimiter(object):
+    def test_shared_by_credential(self):
+        assert shared_limiter("zappos", "a") is shared_limiter("zappos", "a")
+        assert shared_limiter("zappos", "a") is not shared_limiter("zappos", "b")
+
+    def test_updates_from_headers(self, clock):
+        limiter = shared_limiter("reddit")
+        limiter.update({"X-Ratelimit-Remaining": "0", "X-Ratelimit-Reset": "30"})
+        assert not limiter.acquire(timeout=10)
@@ -1,8 +1,24 @@
+from copy import copy
+from urllib.parse import parse_qsl, urlparse
 import json
+import re
 import pytest
+import requests
 import responses
-
-from src.scrape.subreddit import extract_submissions, ingest, paginated_search
+import sqlite3
+
+from src.scrape.extract_links import ingest as ingest_links, mark_processed
+from src.scrape.subreddit import (
+    backfill,
+    extract_submissions,
+    ingest,
+    load_crawl_state,
+    paginated_search,
+    save_crawl_state,
+    time_windows,
+    unprocessed_bodies,
+    window_query,
+)
 
 
 @pytest.fixture(scope="module")
@@ -58,6 +74,27 @@ class TestExtractSubmissions(object):
         medias = [m for _, m in extracted if m is not None]
         assert all(m.txt is None for m in medias)
 
+class TestUnprocessedBodies(object):
+    @pytest.mark.skipif(
+        not hasattr(sqlite3.Connection, "setlimit"),
+        reason="Requires `Connection.setlimit`",
+    )
+    def test_more_submissions_than_params(self, cursor, listing):
+        # As for SQLite before 3.32.
+        cursor.connection.setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, 999)
+        (submission, _), *_ = extract_submissions(listing, "subreddit", "query")
+        submissions = []
+        for i in range(1_000):
+            submission = copy(submission)
+            submission.id = f"s{i}"
+            submission.selftext_html = "<p>body</p>"
+            submissions.append(submission)
+        mark_processed(cursor, [s.id for s in submissions[::2]])
+
+        records = unprocessed_bodies(cursor, submissions)
+
+        assert [id_ for id_, _ in records] == [s.id for s in submissions[1::2]]
+
 class MockSearchResults(object):
     limit = 5  # Ignore requested value.
     headers = {"Content-Type": "application/json"}
@@ -84,8 +121,8 @@ class MockSearchResults(object):
         return json.dumps(data)
 
     def get(self, request):
-        qs = responses.urlparse(request.url).query
-        params = {k: v for k, v in responses.parse_qsl(qs)}
+        qs = urlparse(request.url).query
+        params = {k: v for k, v in parse_qsl(qs)}
         after = params.get("after")
 
         if after is None:
@@ -136,3 +173,277 @@ class TestIngest(object):
         count = cursor.fetchone()[0]
 
         assert count == len(mock_search.children)
+
+    @responses.activate
+    def test_mock_extracting_links(self, cursor, listing):
+        subreddit = "mock"
+        url = f"https://reddit.com/r/{subreddit}/search.json"
+
+        mock_search = MockSearchResults(listing)
+        responses.add_callback(responses.GET, url, mock_search.get)
+
+        ingest(cursor, query="query", subreddit=subreddit, extract_links=True)
+
+        cursor.execute("select count(*) from medias where not is_direct")
+        n_indirect = cursor.fetchone()[0]
+        cursor.execute("select count(*) from links_extracted")
+        n_processed = cursor.fetchone()[0]
+        with_bodies = [
+            s for s in mock_search.children if s["data"]["selftext_html"] is not None
+        ]
+
+        assert n_indirect > 0
+        assert n_processed == len(with_bodies)
+        # Nothing is left for a separate pass.
+        assert ingest_links(cursor) == 0
+
+    @responses.activate
+    def test_mock_extracts_links_once(self, cursor, listing):
+        subreddit = "mock"
+        url = f"https://reddit.com/r/{subreddit}/search.json"
+
+        mock_search = MockSearchResults(listing)
+        responses.add_callback(responses.GET, url, mock_search.get)
+
+        ingest(cursor, query="query", subreddit=subreddit, extract_links=True)
+        cursor.execute("select count(*) from medias where not is_direct")
+        expected = cursor.fetchone()[0]
+        ingest(cursor, query="query", subreddit=subreddit, extract_links=True)
+        cursor.execute("select count(*) from medias where not is_direct")
+
+        assert cursor.fetchone()[0] == expected
+
+class TestResume(object):
+    subreddit = "mock"
+    url = f"https://reddit.com/r/{subreddit}/search.json"
+
+    def fail_after_first_page(self, mock_search):
+        def cb(request):
+            if "after" in dict(parse_qsl(urlparse(request.url).query)):
+                raise requests.ConnectionError("Connection reset")
+            return mock_search.get(request)
+        return cb
+
+    def afters(self):
+        return [
+            dict(parse_qsl(urlparse(call.request.url).query)).get("after")
+            for call in responses.calls
+        ]
+
+    @responses.activate
+    def test_commits_each_page(self, file_cursor, tmp_path, listing):
+        mock_search = MockSearchResults(listing)
+        responses.add_callback(
+            responses.GET,
+            self.url,
+            self.fail_after_first_page(mock_search),
+        )
+
+        with pytest.raises(requests.ConnectionError):
+            ingest(file_cursor, query="query", subreddit=self.subreddit)
+
+        conn = sqlite3.connect(str(tmp_path / "test.db"))
+        count, = conn.execute("select count(*) from submissions").fetchone()
+        state = conn.execute(
+            "select after, pages_done, is_complete from crawl_state"
+        ).fetchall()
+        conn.close()
+
+        first_page = mock_search.children[:mock_search.limit]
+        assert count == len(first_page)
+        assert state == [(first_page[-1]["data"]["id"], 1, 0)]
+
+    @responses.activate
+    def test_resumes_from_cursor(self, cursor, listing):
+        mock_search = MockSearchResults(listing)
+        responses.add_callback(
+            responses.GET,
+            self.url,
+            self.fail_after_first_page(mock_search),
+        )
+        with pytest.raises(requests.ConnectionError):
+            ingest(cursor, query="query", subreddit=self.subreddit)
+
+        responses.reset()
+        responses.add_callback(responses.GET, self.url, mock_search.get)
+        ingest(cursor, query="query", subreddit=self.subreddit, resume=True)
+
+        first_page = mock_search.children[:mock_search.limit]
+        assert self.afters() == [first_page[-1]["data"]["id"]]
+        cursor.execute("select count(*) from submissions")
+        assert cursor.fetchone()[0] == len(mock_search.children)
+        cursor.execute("select after, pages_done, is_complete from crawl_state")
+        assert cursor.fetchall() == [(None, mock_search.max_responses, 1)]
+
+    @responses.activate
+    def test_restarts_complete_crawl(self, cursor, listing):
+        mock_search = MockSearchResults(listing)
+        responses.add_callback(responses.GET, self.url, mock_search.get)
+
+        ingest(cursor, query="query", subreddit=self.subreddit)
+        responses.calls.reset()
+        ingest(cursor, query="query", subreddit=self.subreddit, resume=True)
+
+        assert self.afters()[0] is None
+        assert len(responses.calls) == mock_search.max_responses
+
+def new_child(child, n):
+    data = {
+        **child["data"],
+        "id": f"new{n}",
+        "permalink": f"/r/mock/comments/new{n}/",
+        "created_utc": child["data"]["created_utc"] + 1_000 * n,
+    }
+    return {**child, "data": data}
+
+class TestIncremental(object):
+    subreddit = "mock"
+    url = f"https://reddit.com/r/{subreddit}/search.json"
+
+    @responses.activate
+    def test_crawls_everything_at_first(self, cursor, listing):
+        mock_search = MockSearchResults(listing)
+        responses.add_callback(responses.GET, self.url, mock_search.get)
+
+        ingest(cursor, query="query", subreddit=self.subreddit, incremental=True)
+
+        assert len(responses.calls) == mock_search.max_responses
+        cursor.execute("select count(*) from submissions")
+        assert cursor.fetchone()[0] == len(mock_search.children)
+
+    @responses.activate
+    def test_stops_at_held_submissions(self, cursor, listing):
+        mock_search = MockSearchResults(listing)
+        responses.add_callback(responses.GET, self.url, mock_search.get)
+        ingest(cursor, query="query", subreddit=self.subreddit)
+
+        # New submissions come first, as results are sorted by `new`.
+        first = mock_search.children[0]
+        new = [new_child(first, n) for n in (2, 1)]
+        mock_search.children = new + mock_search.children
+        responses.calls.reset()
+        ingest(cursor, query="query", subreddit=self.subreddit, incremental=True)
+
+        assert len(responses.calls) == 1
+        cursor.execute("select count(*) from submissions where id like 'new%'")
+        assert cursor.fetchone()[0] == 2
+        cursor.execute("select after, is_complete from crawl_state")
+        assert cursor.fetchall() == [(None, 1)]
+
+    @responses.activate
+    def test_keeps_unfinished_crawl(self, cursor, listing):
+        mock_search = MockSearchResults(listing)
+        responses.add_callback(responses.GET, self.url, mock_search.get)
+        ingest(cursor, query="query", subreddit=self.subreddit)
+        save_crawl_state(cursor, self.subreddit, "query", "t3_a", 1)
+
+        first = mock_search.children[0]
+        mock_search.children = [new_child(first, 1)] + mock_search.children
+        ingest(cursor, query="query", subreddit=self.subreddit, incremental=True)
+
+        cursor.execute("select count(*) from submissions where id like 'new%'")
+        assert cursor.fetchone()[0] == 1
+        assert load_crawl_state(cursor, self.subreddit, "query") == ("t3_a", 1)
+
+    @responses.activate
+    def test_continues_past_submissions_held_for_other_queries(self, cursor, listing):
+        mock_search = MockSearchResults(listing)
+        responses.add_callback(responses.GET, self.url, mock_search.get)
+        ingest(cursor, query="other query", subreddit=self.subreddit)
+
+        responses.calls.reset()
+        ingest(cursor, query="query", subreddit=self.subreddit, incremental=True)
+
+        assert len(responses.calls) == mock_search.max_responses
+
+    def test_not_with_resume(self, cursor):
+        with pytest.raises(ValueError):
+            ingest(
+                cursor,
+                query="query",
+                subreddit=self.subreddit,
+                resume=True,
+                incremental=True,
+            )
+
+class WindowedSearchResults(MockSearchResults):
+    """Serves only the submissions in the timestamp window searched for."""
+
+    def __init__(self, listing, fail_windows=()):
+        super().__init__(listing)
+        self.all_children = self.children
+        self.fail_windows = fail_windows
+
+    def get(self, request):
+        params = dict(parse_qsl(urlparse(request.url).query))
+        assert params["syntax"] == "cloudsearch"
+        match = re.search(r"timestamp:(\d+)\.\.(\d+)", params["q"])
+        lower, upper = map(int, match.groups())
+        if (lower, upper) in self.fail_windows:
+            return (500, {}, "")
+
+        self.children = [
+            child
+            for child in self.all_children
+            if lower <= child["data"]["created_utc"] <= upper
+        ]
+        return super().get(request)
+
+class TestBackfill(object):
+    subreddit = "mock"
+    url = f"https://reddit.com/r/{subreddit}/search.json"
+    # Two windows, of five submissions each.
+    windows = time_windows(1_549_400_000, 1_550_299_999, 450_000)
+
+    def test_time_windows(self):
+        assert time_windows(0, 25, 10) == [(0, 9), (10, 19), (20, 25)]
+        assert time_windows(0, 19, 10) == [(0, 9), (10, 19)]
+
+    def test_window_query(self):
+        assert window_query("", (1, 2)) == "timestamp:1..2"
+        assert window_query("it's", (1, 2)) == "(and timestamp:1..2 'it\\'s')"
+
+    @pytest.mark.parametrize("workers", [1, 2])
+    @responses.activate
+    def test_crawls_every_window(self, cursor, listing, workers):
+        mock_search = WindowedSearchResults(listing)
+        responses.add_callback(responses.GET, self.url, mock_search.get)
+
+        n_written = backfill(cursor, "query", self.subreddit, self.windows, workers)
+
+        assert len(responses.calls) == 2
+        assert n_written == len(mock_search.all_children)
+        cursor.execute("select distinct search_query from submissions")
+        assert cursor.fetchall() == [("query",)]
+        cursor.execute("select count(*) from crawl_state where is_complete")
+        assert cursor.fetchone()[0] == len(self.windows)
+
+    @responses.activate
+    def test_resumes_failed_windows(self, cursor, listing):
+        mock_search = WindowedSearchResults(listing, fail_windows={self.windows[1]})
+        responses.add_callback(responses.GET, self.url, mock_search.get)
+
+        with pytest.raises(requests.HTTPError):
+            backfill(cursor, "query", self.subreddit, self.windows)
+
+        cursor.execute("select count(*) from submissions")
+        assert cursor.fetchone()[0] == 5
+
+        mock_search.fail_windows = ()
+        responses.calls.reset()
+        backfill(cursor, "query", self.subreddit, self.windows)
+
+        # Only the failed window is crawled again.
+        assert len(responses.calls) == 1
+        cursor.execute("select count(*) from submissions")
+        assert cursor.fetchone()[0] == len(mock_search.all_children)
+
+    @responses.activate
+    def test_extracts_links(self, cursor, listing):
+        mock_search = WindowedSearchResults(listing)
+        responses.add_callback(responses.GET, self.url, mock_search.get)
+
+        backfill(cursor, "query", self.subreddit, self.windows, extract_links=True)
+
+        # Nothing is left for a separate pass.
+        assert ingest_links(cursor) == 0
@@ -0,0 +1,83 @@
+from threading import Thread
+from unittest.mock import patch
+import pytest
+import requests
+import socket
+
+from src.scrape.images import TRANSIENT_ERRORS
+from src.scrape.transport import Session, default_session, make_session
+
+
+@pytest.fixture
+def unresponsive_server():
+    # Accepts connections, but never responds on them.
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen()
+    connections = []
+
+    def accept():
+        while True:
+            try:
+                connection, _ = server.accept()
+            except OSError:
+                return
+            connections.append(connection)
+
+    Thread(target=accept, daemon=True).start()
+    host, port = server.getsockname()
+    yield f"http://{host}:{port}", connections
+    server.close()
+    for connection in connections:
+        connection.close()
+
+
+class TestSession(object):
+    url = "https://mock.com/path"
+
+    def test_sets_default_timeout(self):
+        session = Session(timeout=5)
+        with patch.object(requests.Session, "request") as patched:
+            session.request("GET", self.url)
+
+        _, kwds = patched.call_args
+        assert kwds["timeout"] == 5
+
+    def test_keeps_given_timeout(self):
+        session = Session(timeout=5)
+        with patch.object(requests.Session, "request") as patched:
+            session.request("GET", self.url, timeout=1)
+
+        _, kwds = patched.call_args
+        assert kwds["timeout"] == 1
+
+class TestMakeSession(object):
+    def test_configures_retries(self):
+        session = make_session(retries=3)
+        adapter = session.get_adapter("https://mock.com")
+
+        assert adapter.max_retries.total == 3
+        # Error statuses are left to clients.
+        assert adapter.max_retries.status == 0
+
+    def test_retries_read_timeouts(self, unresponsive_server):
+        url, connections = unresponsive_server
+        session = make_session(timeout=.05, retries=2, backoff=0)
+
+        # Reads which time out on every retry surface as a connection
+        # error, which ingests must still treat as transient.
+        with pytest.raises(requests.ConnectionError) as exc_info:
+            session.get(url)
+
+        assert isinstance(exc_info.value, TRANSIENT_ERRORS)
+        assert len(connections) == 3
+
+    def test_sizes_host_pools(self):
+        session = make_session(pool_size=2, host_pool_sizes={"https://i.imgur.com": 8})
+
+        assert session.get_adapter("https://mock.com/a")._pool_maxsize == 2
+        assert session.get_adapter("https://i.imgur.com/a.jpg")._pool_maxsize == 8
+
+class TestDefaultSession(object):
+    def test_is_shared(self):
+        assert default_session() is default_session()
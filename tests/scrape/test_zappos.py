@@ -5,15 +5,29 @@ import json
 import pytest
 import requests
 import responses
+import sqlite3
 
 from src.scrape.models import ProductSearchResult
+from src.scrape.ratelimit import RateLimiter, TokenBucket, zappos_limit
 from src.scrape.zappos import (
+    RETRY_BASE_SECONDS,
+    RETRY_MAX_SECONDS,
     SKIP_PRODUCT_STATUSES,
     ZapposClient,
+    compress_description,
+    derive_description,
     extract_description,
+    fetch_candidates,
     get_products,
+    ingest_products,
+    ingest_search,
+    iter_search_pages,
+    next_eligible,
     paginated_search,
-    reset_time,
+    read_terms,
+    record_failure,
+    rederive_descriptions,
+    run_campaign,
     strip_legal_signs,
 )
 
@@ -24,50 +38,12 @@ def product_response():
         response_data = json.load(fh)
     return response_data
 
+@pytest.fixture
+def described_product_response(product_response):
+    product, = product_response["product"]
+    description = "<ul><li>Other</li><li>UGG\N{REGISTERED SIGN} boots.</li></ul>"
+    return {**product_response, "product": [{**product, "description": description}]}
 
-class TestResetTime(object):
-    def test_when_reset_is_unnecessary(self):
-        headers = {
-            "X-RateLimit-Short-RateRemaining": "4",
-            "X-RateLimit-Long-RateRemaining": "2000",
-        }
-        wait_seconds = reset_time(headers)
-        assert wait_seconds == 0
-
-    def test_when_short_limit_is_low(self):
-        # Ensure reset time is in the future.
-        ms = int(time() * 1000) + 100_000
-        headers = {
-            "X-RateLimit-Short-RateRemaining": "1",
-            "X-RateLimit-Short-RateReset": str(ms),
-            "X-RateLimit-Long-RateRemaining": "2000",
-        }
-        wait_seconds = reset_time(headers)
-        assert wait_seconds > 0
-
-    def test_when_long_limit_is_low(self):
-        # Ensure reset time is in the future.
-        ms = int(time() * 1000) + 100_000
-        headers = {
-            "X-RateLimit-Short-RateRemaining": "4",
-            "X-RateLimit-Long-RateRemaining": "1",
-            "X-RateLimit-Long-RateReset": str(ms),
-        }
-        wait_seconds = reset_time(headers)
-        assert wait_seconds > 0
-
-    def test_long_reset_when_limits_are_both_low(self):
-        # Ensure long reset time is in the future,
-        # and short reset time will be negative.
-        ms = int(time() * 1000) + 100_000
-        headers = {
-            "X-RateLimit-Short-RateRemaining": "1",
-            "X-RateLimit-Short-RateReset": "-1000",
-            "X-RateLimit-Long-RateRemaining": "1",
-            "X-RateLimit-Long-RateReset": str(ms),
-        }
-        wait_seconds = reset_time(headers)
-        assert wait_seconds > 0
 
 class TestStripLegalSigns(object):
     @pytest.mark.parametrize(
@@ -129,6 +105,9 @@ class TestExtractDescription(object):
         ])
         assert extract_description(html, "Brand") == expected
 
+def unlimited():
+    return RateLimiter(TokenBucket(rate=1_000, capacity=1_000), zappos_limit)
+
 def headers():
     return {
         "Content-Type": "application/json",
@@ -173,8 +152,43 @@ class TestZapposClient(object):
         responses.add(responses.GET, self.url, status=200)
 
         client = ZapposClient(self.key)
-        client.retry_delay_seconds = .1
-        client.dispatch("GET", self.url)
+        with patch("src.scrape.zappos.sleep", return_value=None) as patched_sleep:
+            client.dispatch("GET", self.url)
+
+        assert patched_sleep.call_count == 1
+
+    @responses.activate
+    def test_dispatch_waits_for_limiter_when_throttled(self):
+        reset_ms = int(1000 * (time() + 30))
+        headers = {
+            "X-RateLimit-Short-RateRemaining": "0",
+            "X-RateLimit-Short-RateReset": str(reset_ms),
+        }
+        responses.add(responses.GET, self.url, status=429, headers=headers)
+        responses.add(responses.GET, self.url, status=200)
+
+        client = ZapposClient(self.key)
+        with patch("src.scrape.zappos.sleep", return_value=None) as backoff_sleep, \
+                patch("src.scrape.ratelimit.sleep", return_value=None) as limit_sleep:
+            client.dispatch("GET", self.url)
+
+        # The backoff is brief, with the limiter waiting out the reset.
+        backoff_seconds, = backoff_sleep.call_args[0]
+        assert backoff_seconds <= client.max_backoff_seconds
+        limit_seconds, = limit_sleep.call_args[0]
+        assert limit_seconds > 20
+
+    @responses.activate
+    def test_dispatch_gives_up_when_throttled(self):
+        responses.add(responses.GET, self.url, status=429)
+
+        client = ZapposClient(self.key)
+        with patch("src.scrape.zappos.sleep", return_value=None) as patched_sleep:
+            with pytest.raises(requests.HTTPError):
+                client.dispatch("GET", self.url)
+
+        assert len(responses.calls) == client.max_retries + 1
+        assert patched_sleep.call_count == client.max_retries
 
     @responses.activate
     def test_dispatch_raises_unknown_error(self):
@@ -199,11 +213,18 @@ class TestZapposClient(object):
 
         responses.add_callback(responses.GET, self.url, callback=cb)
 
-        with patch("src.scrape.zappos.sleep", return_value=None) as patched_sleep:
+        with patch("src.scrape.ratelimit.sleep", return_value=None) as patched_sleep:
             client = ZapposClient(self.key)
+            # The one remaining request is let through, and the next
+            # waits for the limit to reset.
+            client.dispatch("GET", self.url)
             client.dispatch("GET", self.url)
+            assert patched_sleep.call_count == 0
 
+            client.dispatch("GET", self.url)
             assert patched_sleep.call_count == 1
+            wait_seconds, = patched_sleep.call_args[0]
+            assert 0 < wait_seconds <= delay_seconds
 
     @responses.activate
     def test_gets_product(self, product_response):
@@ -260,6 +281,25 @@ class TestZapposClient(object):
         client = ZapposClient(self.key)
         client.search(term, int(page), int(limit))
 
+class TestDescriptionHtml(object):
+    def test_round_trip(self):
+        html = "<ul><li>Brand shoes</li></ul>"
+        assert derive_description(compress_description(html), "Brand") == "Brand shoes"
+
+    @pytest.mark.parametrize("parse, expected", [(True, "UGG boots."), (False, None)])
+    @responses.activate
+    def test_keeps_html(self, described_product_response, parse, expected):
+        url = "http://api.zappos.com/Product/1"
+        responses.add(responses.GET, url, json=described_product_response)
+
+        client = ZapposClient("api-key")
+        product = client.product_description(1, parse=parse)
+
+        product_data, = described_product_response["product"]
+        html = compress_description(product_data["description"])
+        assert product.description == expected
+        assert product.description_html == html
+
 class TestGetProducts(object):
     @pytest.mark.parametrize("status_code", SKIP_PRODUCT_STATUSES)
     @responses.activate
@@ -290,6 +330,200 @@ class TestGetProducts(object):
         assert products[0].id == p_ids[0]
         assert products[1].id == p_ids[1]
 
+    @responses.activate
+    def test_concurrent(self, product_response):
+        p_ids = list(range(100, 120))
+        psrs = []
+        for p_id in p_ids:
+            psr = ProductSearchResult("brand", p_id, "name", "category", "query")
+            url = f"http://api.zappos.com/Product/{psr.product_id}"
+            if p_id % 5 == 0:
+                responses.add(responses.GET, url, status=404)
+            else:
+                responses.add(responses.GET, url, json=product_response)
+            psrs.append(psr)
+
+        client = ZapposClient("api-key", limiter=unlimited())
+        products = list(get_products(client, psrs, workers=4))
+
+        assert sorted(p.id for p in products) == [p_id for p_id in p_ids if p_id % 5]
+
+    @responses.activate
+    def test_raises_unskippable_errors(self):
+        psr = ProductSearchResult("brand", 123, "name", "category", "query")
+        url = f"http://api.zappos.com/Product/{psr.product_id}"
+        responses.add(responses.GET, url, status=401)
+
+        client = ZapposClient("api-key")
+        with pytest.raises(requests.RequestException):
+            list(get_products(client, [psr], workers=2))
+
+class TestIngestProducts(object):
+    @responses.activate
+    def test_commits_periodically(self, file_cursor, tmp_path, product_response):
+        psrs = []
+        for p_id in range(1, 6):
+            psr = ProductSearchResult("brand", p_id, "name", "category", "query")
+            url = f"http://api.zappos.com/Product/{psr.product_id}"
+            if p_id == 5:
+                responses.add(responses.GET, url, status=500)
+            else:
+                responses.add(responses.GET, url, json=product_response)
+            psrs.append(psr)
+
+        client = ZapposClient("api-key")
+        with pytest.raises(requests.RequestException):
+            ingest_products(file_cursor, client, psrs, commit_interval=2)
+
+        # Only committed products are seen by another connection.
+        conn = sqlite3.connect(str(tmp_path / "test.db"))
+        count, = conn.execute("select count(*) from products").fetchone()
+        conn.close()
+        assert count == 4
+
+    @responses.activate
+    def test_writes_products(self, cursor, product_response):
+        psrs = []
+        for p_id in range(1, 4):
+            psr = ProductSearchResult("brand", p_id, "name", "category", "query")
+            url = f"http://api.zappos.com/Product/{psr.product_id}"
+            responses.add(responses.GET, url, json=product_response)
+            psrs.append(psr)
+
+        client = ZapposClient("api-key")
+        n_written = ingest_products(cursor, client, psrs, workers=2)
+
+        cursor.execute("select id from products order by id")
+        assert n_written == 3
+        assert cursor.fetchall() == [(1,), (2,), (3,)]
+
+    @responses.activate
+    def test_records_failures(self, cursor, product_response):
+        psrs = []
+        for p_id, status in ((1, 200), (2, 404), (3, 504)):
+            psr = ProductSearchResult("brand", p_id, "name", "category", "query")
+            url = f"http://api.zappos.com/Product/{psr.product_id}"
+            responses.add(responses.GET, url, status=status, json=product_response)
+            psrs.append(psr)
+
+        client = ZapposClient("api-key")
+        ingest_products(cursor, client, psrs)
+
+        cursor.execute("select product_id, status, attempts from product_fetches")
+        assert sorted(cursor.fetchall()) == [(2, 404, 1), (3, 504, 1)]
+
+    @responses.activate
+    def test_parses_descriptions(self, cursor, described_product_response):
+        psrs = []
+        for p_id in range(1, 11):
+            psr = ProductSearchResult("UGG", p_id, "name", "category", "query")
+            url = f"http://api.zappos.com/Product/{psr.product_id}"
+            responses.add(responses.GET, url, json=described_product_response)
+            psrs.append(psr)
+
+        client = ZapposClient("api-key", limiter=unlimited())
+        ingest_products(cursor, client, psrs, workers=2, processes=2)
+
+        cursor.execute("select description from products")
+        assert cursor.fetchall() == [("UGG boots.",)] * len(psrs)
+
+    @responses.activate
+    def test_parses_inline_with_one_process(self, cursor, described_product_response):
+        psr = ProductSearchResult("UGG", 1, "name", "category", "query")
+        url = f"http://api.zappos.com/Product/{psr.product_id}"
+        responses.add(responses.GET, url, json=described_product_response)
+
+        client = ZapposClient("api-key", limiter=unlimited())
+        with patch("src.scrape.zappos.ProcessPoolExecutor") as patched_executor:
+            ingest_products(cursor, client, [psr], workers=2, processes=1)
+
+        assert not patched_executor.called
+        cursor.execute("select description from products")
+        assert cursor.fetchall() == [("UGG boots.",)]
+
+class TestRederiveDescriptions(object):
+    def test_rederives(self, cursor):
+        html = compress_description("<ul><li>Brand shoes</li></ul>")
+        cursor.executemany(
+            """
+            insert into products (
+                id, brand, name, default_url, description, description_html
+            )
+            values (?, 'Brand', 'name', 'url', 'stale', ?)
+            """,
+            [(1, html), (2, html), (3, None)]
+        )
+
+        n_derived = rederive_descriptions(cursor, processes=2, chunk_size=1)
+
+        cursor.execute("select id, description from products order by id")
+        assert n_derived == 2
+        assert cursor.fetchall() == [
+            (1, "Brand shoes"),
+            (2, "Brand shoes"),
+            (3, "stale"),
+        ]
+
+class TestNextEligible(object):
+    def test_permanent(self):
+        assert next_eligible(404, 1, now=0) is None
+
+    def test_backs_off_exponentially(self):
+        waits = [next_eligible(504, attempts, now=0) for attempts in (1, 2, 3)]
+        assert waits == [n * RETRY_BASE_SECONDS for n in (1, 2, 4)]
+
+    def test_capped(self):
+        assert next_eligible(504, 100, now=0) == RETRY_MAX_SECONDS
+
+def insert_search(cursor, product_id, query="query"):
+    cursor.execute(
+        """
+        insert into searches (brand, product_id, product_name, category, search_query)
+        values ('brand', ?, 'name', 'Boots', ?)
+        """,
+        (product_id, query)
+    )
+
+class TestFetchCandidates(object):
+    def test_counts_attempts(self, cursor):
+        record_failure(cursor, 1, 504)
+        record_failure(cursor, 1, 504)
+        cursor.execute("select attempts, next_eligible_utc from product_fetches")
+        attempts, next_eligible_utc = cursor.fetchone()
+        assert attempts == 2
+        assert next_eligible_utc > time() + RETRY_BASE_SECONDS
+
+    def test_excludes_failed_products(self, cursor):
+        for product_id in (1, 2, 3, 4):
+            insert_search(cursor, product_id)
+        cursor.executemany(
+            """
+            insert into product_fetches (product_id, status, attempts, next_eligible_utc)
+            values (?, ?, 1, ?)
+            """,
+            [(2, 404, None), (3, 504, 200), (4, 504, 50)]
+        )
+
+        records = fetch_candidates(cursor, now=100)
+
+        # Permanently failed, and not yet eligible, products are excluded.
+        assert sorted(r.product_id for r in records) == [1, 4]
+
+    def test_excludes_fetched_products(self, cursor):
+        insert_search(cursor, 1)
+        insert_search(cursor, 1, "other query")
+        insert_search(cursor, 2)
+        cursor.execute(
+            """
+            insert into products (id, brand, name, default_url)
+            values (2, 'brand', 'name', 'url')
+            """
+        )
+
+        records = fetch_candidates(cursor, now=0)
+
+        assert [r.product_id for r in records] == [1]
+
 
 class TestPaginatedSearch(object):
     key = "api-key"
@@ -323,3 +557,175 @@ class TestPaginatedSearch(object):
 
         assert len(search_results) == expected_count
         assert cb.request_count == expected_count
+
+def search_callback(total, page_size):
+    # Pages of results, with product ids numbered across pages.
+    def cb(request):
+        params = dict(parse_qsl(urlparse(request.url).query))
+        page = int(params["page"])
+        first = (page - 1) * page_size
+        content = json.dumps({
+            "totalResultCount": str(total),
+            "status": "200",
+            "results": [
+                {
+                    "brandName": "brand",
+                    "productId": str(product_id),
+                    "productName": "brand's product",
+                    "categoryFacet": "Shoes",
+                }
+                for product_id in range(first, min(first + page_size, total))
+            ],
+        })
+        return (200, {"Content-Type": "application/json"}, content)
+    return cb
+
+class TestIterSearchPages(object):
+    url = "http://api.zappos.com/Search"
+
+    @pytest.mark.parametrize("workers", [1, 4])
+    @responses.activate
+    def test_gets_every_page(self, workers):
+        responses.add_callback(responses.GET, self.url, callback=search_callback(23, 5))
+
+        client = ZapposClient("api-key", limiter=unlimited())
+        pages = list(iter_search_pages(client, "query", workers))
+
+        assert len(pages) == 5
+        assert len(responses.calls) == 5
+        product_ids = sorted(r.product_id for results in pages for r in results)
+        assert product_ids == list(range(23))
+        assert all(r.search_query == "query" for results in pages for r in results)
+
+    @responses.activate
+    def test_no_results(self):
+        responses.add_callback(responses.GET, self.url, callback=search_callback(0, 5))
+
+        client = ZapposClient("api-key")
+        pages = list(iter_search_pages(client, "query", workers=4))
+
+        assert pages == [[]]
+        assert len(responses.calls) == 1
+
+    @responses.activate
+    def test_paginated_search_is_concurrent(self):
+        responses.add_callback(responses.GET, self.url, callback=search_callback(10, 3))
+
+        client = ZapposClient("api-key", limiter=unlimited())
+        search_results = paginated_search(client, "query", workers=2)
+
+        assert sorted(r.product_id for r in search_results) == list(range(10))
+
+def term_search_callback(products_by_term, fail_terms=()):
+    def cb(request):
+        params = dict(parse_qsl(urlparse(request.url).query))
+        term = params["term"]
+        if term in fail_terms:
+            return (500, {}, None)
+
+        product_ids = products_by_term[term]
+        content = json.dumps({
+            "totalResultCount": str(len(product_ids)),
+            "status": "200",
+            "results": [
+                {
+                    "brandName": "brand",
+                    "productId": str(product_id),
+                    "productName": "brand's product",
+                    "categoryFacet": "Shoes",
+                }
+                for product_id in product_ids
+            ],
+        })
+        return (200, {"Content-Type": "application/json"}, content)
+    return cb
+
+class TestCampaign(object):
+    url = "http://api.zappos.com/Search"
+    products_by_term = {"a": [1, 2], "b": [2, 3], "c": [4]}
+
+    def test_read_terms(self, tmp_path):
+        path = tmp_path / "terms.txt"
+        path.write_text("a\n\n# Comment\n b \na\nc\n")
+        assert read_terms(str(path)) == ["a", "b", "c"]
+
+    @pytest.mark.parametrize("workers", [1, 3])
+    @responses.activate
+    def test_dedupes_products(self, cursor, workers):
+        responses.add_callback(
+            responses.GET,
+            self.url,
+            callback=term_search_callback(self.products_by_term),
+        )
+
+        client = ZapposClient("api-key", limiter=unlimited())
+        n_written = run_campaign(cursor, client, ["a", "b", "c"], workers)
+
+        cursor.execute("select product_id from searches order by product_id")
+        assert n_written == 4
+        assert cursor.fetchall() == [(1,), (2,), (3,), (4,)]
+
+    @responses.activate
+    def test_resumes(self, cursor):
+        fail_terms = {"b"}
+        responses.add_callback(
+            responses.GET,
+            self.url,
+            callback=term_search_callback(self.products_by_term, fail_terms),
+        )
+
+        client = ZapposClient("api-key", limiter=unlimited())
+        with pytest.raises(requests.RequestException):
+            run_campaign(cursor, client, ["a", "b", "c"])
+
+        cursor.execute("select search_query from completed_searches")
+        assert cursor.fetchall() == [("a",)]
+
+        fail_terms.clear()
+        n_calls = len(responses.calls)
+        run_campaign(cursor, client, ["a", "b", "c"])
+
+        # Only the remaining terms are searched for.
+        assert len(responses.calls) == n_calls + 2
+        cursor.execute("select product_id, search_query from searches order by 1")
+        assert cursor.fetchall() == [(1, "a"), (2, "a"), (3, "b"), (4, "c")]
+
+class TestIngestSearch(object):
+    url = "http://api.zappos.com/Search"
+
+    @responses.activate
+    def test_commits_each_page(self, file_cursor, tmp_path):
+        callback = search_callback(9, 3)
+
+        def cb(request):
+            params = dict(parse_qsl(urlparse(request.url).query))
+            if params["page"] == "3":
+                return (500, {}, None)
+            return callback(request)
+
+        responses.add_callback(responses.GET, self.url, callback=cb)
+
+        client = ZapposClient("api-key", limiter=unlimited())
+        with pytest.raises(requests.RequestException):
+            ingest_search(file_cursor, client, "query")
+
+        conn = sqlite3.connect(str(tmp_path / "test.db"))
+        count, = conn.execute("select count(*) from searches").fetchone()
+        completed = conn.execute("select * from completed_searches").fetchall()
+        conn.close()
+        assert count == 6
+        assert completed == []
+
+    @responses.activate
+    def test_rerun_is_idempotent(self, cursor):
+        responses.add_callback(responses.GET, self.url, callback=search_callback(9, 3))
+
+        client = ZapposClient("api-key", limiter=unlimited())
+        assert ingest_search(cursor, client, "query") == 9
+        ingest_search(cursor, client, "query")
+        ingest_search(cursor, client, "other query")
+
+        cursor.execute("select search_query, count(*) from searches group by 1")
+        assert sorted(cursor.fetchall()) == [("other query", 9), ("query", 9)]
+        cursor.execute("select search_query from completed_searches order by 1")
+        assert cursor.fetchall() == [("other query",), ("query",)]
@@ -1,10 +1,11 @@
 import pytest
+import sqlite3
 
-from src.utils import create_views
+from src.utils import MIGRATIONS, create_views, migrate
 
 
 class TestCreateViews(object):
-    @pytest.mark.parametrize("view_name", ["media_rollups", "rollups"])
+    @pytest.mark.parametrize("view_name", ["media_images", "media_rollups", "rollups"])
     def test_view_is_created(self, cursor, view_name):
         create_views(cursor)
 
@@ -12,3 +13,102 @@ class TestCreateViews(object):
         # does not matter.
         cursor.execute(f"select count(*) from {view_name}")
         cursor.fetchone()
+
+class TestMigrate(object):
+    def test_records_version(self, cursor):
+        cursor.execute("pragma user_version")
+        assert cursor.fetchone()[0] == len(MIGRATIONS)
+
+    def test_is_idempotent(self, cursor):
+        # The fixture has already applied all migrations.
+        migrate(cursor)
+        cursor.execute("pragma user_version")
+        assert cursor.fetchone()[0] == len(MIGRATIONS)
+
+    def test_backfills_extracted_links(self):
+        with open("src/sql/schema.sql") as fh:
+            setup_sql = fh.read()
+
+        conn = sqlite3.connect(":memory:")
+        conn.executescript(setup_sql)
+        conn.executescript(
+            """
+            insert into medias (submission_id, url, is_direct)
+            values
+                ('direct', 'https://i.redd.it/a.jpg', 1),
+                ('indirect', 'https://i.redd.it/b.jpg', 0),
+                ('indirect', 'https://i.redd.it/c.jpg', 0);
+            """
+        )
+        cursor = conn.cursor()
+
+        migrate(cursor)
+        cursor.execute("select submission_id from links_extracted")
+        processed = cursor.fetchall()
+        conn.close()
+
+        assert processed == [("indirect",)]
+
+    def test_backfills_completed_searches(self):
+        with open("src/sql/schema.sql") as fh:
+            setup_sql = fh.read()
+
+        conn = sqlite3.connect(":memory:")
+        conn.executescript(setup_sql)
+        conn.executescript(
+            """
+            insert into searches (brand, product_id, product_name, category, search_query)
+            values
+                ('brand', 1, 'name', 'Boots', 'a'),
+                ('brand', 2, 'name', 'Boots', 'a'),
+                ('brand', 2, 'name', 'Boots', 'b');
+            """
+        )
+        cursor = conn.cursor()
+
+        migrate(cursor)
+        cursor.execute("select search_query from completed_searches order by 1")
+        completed = cursor.fetchall()
+        conn.close()
+
+        assert completed == [("a",), ("b",)]
+
+    def test_collapses_duplicate_searches(self):
+        with open("src/sql/schema.sql") as fh:
+            setup_sql = fh.read()
+
+        conn = sqlite3.connect(":memory:")
+        conn.executescript(setup_sql)
+        conn.executescript(
+            """
+            insert into searches (brand, product_id, product_name, category, search_query)
+            values
+                ('first', 1, 'name', 'Boots', 'a'),
+                ('second', 1, 'name', 'Boots', 'a'),
+                ('brand', 1, 'name', 'Boots', 'b'),
+                ('brand', 2, 'name', 'Boots', 'a');
+            """
+        )
+        cursor = conn.cursor()
+
+        migrate(cursor)
+        cursor.execute(
+            "select brand, product_id, search_query from searches order by 2, 3"
+        )
+        searches = cursor.fetchall()
+        with pytest.raises(sqlite3.IntegrityError):
+            cursor.execute(
+                """
+                insert into searches (
+                    brand, product_id, product_name, category, search_query
+                )
+                values ('brand', 2, 'name', 'Boots', 'a')
+                """
+            )
+        conn.close()
+
+        assert searches == [
+            ("first", 1, "a"),
+            ("brand", 1, "b"),
+            ("brand", 2, "a"),
+        ]